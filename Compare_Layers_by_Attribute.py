@@ -1,7 +1,17 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from qgis.core import (QgsProcessing, QgsProcessingAlgorithm, QgsProcessingParameterVectorLayer,
                        QgsProcessingParameterFeatureSink, QgsProcessingParameterField,
-                       QgsProcessingParameterEnum, QgsFeatureSink, QgsProcessingException,
-                       QgsWkbTypes, QgsFeature)
+                       QgsProcessingParameterEnum, QgsProcessingParameterNumber, QgsFeatureSink,
+                       QgsProcessingException, QgsWkbTypes, QgsFeature, QgsFeatureRequest, QgsGeometry,
+                       QgsSpatialIndex, QgsCoordinateTransform, QgsVectorLayerFeatureSource,
+                       QgsProcessingParameterDefinition)
+
+try:
+    from .johan_profiler import add_profile_parameter, profiled
+except ImportError:
+    # Added through "Add Script" - QGIS puts its scripts folder on sys.path, so johan_profiler.py has to go there too
+    from johan_profiler import add_profile_parameter, profiled
 
 class CompareLayersAlgorithm(QgsProcessingAlgorithm):
     OLD_LAYER = 'OLD_LAYER'
@@ -9,7 +19,18 @@ class CompareLayersAlgorithm(QgsProcessingAlgorithm):
     OLD_LAYER_ATTRIBUTE = 'OLD_LAYER_ATTRIBUTE'
     NEW_LAYER_ATTRIBUTE = 'NEW_LAYER_ATTRIBUTE'
     SELECTION_OPTION = 'SELECTION_OPTION'
+    MATCH_MODE = 'MATCH_MODE'
+    TOLERANCE = 'TOLERANCE'
+    OVERLAP_RATIO = 'OVERLAP_RATIO'
+    PARALLEL_WORKERS = 'PARALLEL_WORKERS'
+    CHUNK_SIZE = 'CHUNK_SIZE'
     OUTPUT_LAYER = 'OUTPUT_LAYER'
+
+    # Match modes
+    MATCH_ATTRIBUTE = 0
+    MATCH_EQUAL = 1
+    MATCH_TOLERANCE = 2
+    MATCH_OVERLAP = 3
     
     def initAlgorithm(self, config=None):
         self.addParameter(
@@ -28,12 +49,28 @@ class CompareLayersAlgorithm(QgsProcessingAlgorithm):
             )
         )
         
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.MATCH_MODE,
+                'Match features by',
+                options=[
+                    'Attribute value',
+                    'Equal geometry',
+                    'Geometry within tolerance',
+                    'Overlap ratio above threshold'
+                ],
+                defaultValue=self.MATCH_ATTRIBUTE
+            )
+        )
+        
+        # Only needed when matching by attribute value
         self.addParameter(
             QgsProcessingParameterField(
                 self.OLD_LAYER_ATTRIBUTE,
                 'Attribute from Old Layer',
                 parentLayerParameterName=self.OLD_LAYER,
-                type=QgsProcessingParameterField.Any
+                type=QgsProcessingParameterField.Any,
+                optional=True
             )
         )
         
@@ -42,7 +79,29 @@ class CompareLayersAlgorithm(QgsProcessingAlgorithm):
                 self.NEW_LAYER_ATTRIBUTE,
                 'Attribute from New Layer',
                 parentLayerParameterName=self.NEW_LAYER,
-                type=QgsProcessingParameterField.Any
+                type=QgsProcessingParameterField.Any,
+                optional=True
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.TOLERANCE,
+                'Tolerance for geometry within tolerance (in the smaller layer\'s CRS units)',
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0.5,
+                minValue=0
+            )
+        )
+        
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.OVERLAP_RATIO,
+                'Minimum overlap ratio (shared area / combined area) for polygons',
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0.8,
+                minValue=0,
+                maxValue=1
             )
         )
         
@@ -66,20 +125,69 @@ class CompareLayersAlgorithm(QgsProcessingAlgorithm):
                 QgsProcessing.TypeVectorAnyGeometry
             )
         )
+        
+        # 1 worker reads the layer straight through, more split it into feature id chunks read on threads
+        workers = QgsProcessingParameterNumber(
+            self.PARALLEL_WORKERS,
+            'Worker threads',
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=1,
+            minValue=1,
+            maxValue=64
+        )
+        workers.setFlags(workers.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(workers)
+        
+        chunk_size = QgsProcessingParameterNumber(
+            self.CHUNK_SIZE,
+            'Features per chunk (with more than 1 worker)',
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=50000,
+            minValue=100
+        )
+        chunk_size.setFlags(chunk_size.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(chunk_size)
+
+        add_profile_parameter(self)
     
+    @profiled
     def processAlgorithm(self, parameters, context, feedback):
         old_layer = self.parameterAsVectorLayer(parameters, self.OLD_LAYER, context)
         new_layer = self.parameterAsVectorLayer(parameters, self.NEW_LAYER, context)
         old_layer_attribute = self.parameterAsString(parameters, self.OLD_LAYER_ATTRIBUTE, context)
         new_layer_attribute = self.parameterAsString(parameters, self.NEW_LAYER_ATTRIBUTE, context)
         selection_option = self.parameterAsEnum(parameters, self.SELECTION_OPTION, context)
+        match_mode = self.parameterAsEnum(parameters, self.MATCH_MODE, context)
+        tolerance = self.parameterAsDouble(parameters, self.TOLERANCE, context)
+        min_ratio = self.parameterAsDouble(parameters, self.OVERLAP_RATIO, context)
+        workers = self.parameterAsInt(parameters, self.PARALLEL_WORKERS, context)
+        chunk_size = self.parameterAsInt(parameters, self.CHUNK_SIZE, context)
         
         if not new_layer or not old_layer:
             raise QgsProcessingException(self.invalidSourceError(parameters, self.NEW_LAYER if not new_layer else self.OLD_LAYER))
         
-        # Create sets of attribute values from both layers
-        old_attr_set = set(feature[old_layer_attribute] for feature in old_layer.getFeatures())
-        new_attr_set = set(feature[new_layer_attribute] for feature in new_layer.getFeatures())
+        if match_mode == self.MATCH_ATTRIBUTE:
+            if not old_layer_attribute or not new_layer_attribute:
+                raise QgsProcessingException('Choose an attribute from both layers to match by attribute value')
+            
+            if selection_option == 1:  # Select features in the old layer that are not in the new layer
+                probe_layer, probe_attribute = old_layer, old_layer_attribute
+                key_layer, key_attribute = new_layer, new_layer_attribute
+            else:  # Select features in the new layer that are (0) or are not (2) in the old layer
+                probe_layer, probe_attribute = new_layer, new_layer_attribute
+                key_layer, key_attribute = old_layer, old_layer_attribute
+            keep_found = selection_option == 0
+            
+            # Only the other layer's values are needed up front - the probe layer is read once, by mapped_features
+            with self.profiler.phase('read key values'):
+                request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+                request.setSubsetOfAttributes([key_attribute], key_layer.fields())
+                key_set = set(feature[key_attribute] for feature in key_layer.getFeatures(request))
+            self.profiler.count('features read', key_layer.featureCount())
+        elif match_mode == self.MATCH_OVERLAP:
+            for layer in (old_layer, new_layer):
+                if layer.geometryType() != QgsWkbTypes.PolygonGeometry:
+                    raise QgsProcessingException(f'{layer.name()} is not a polygon layer - overlap ratio only works on polygons')
         
         # Determine the output layer geometry type and fields
         if selection_option in [0, 2]:  # Use new layer geometry for common or new-only features
@@ -95,28 +203,205 @@ class CompareLayersAlgorithm(QgsProcessingAlgorithm):
         
         # Select features based on the chosen option
         count = 0
-        if selection_option == 0:  # Select features common to both layers
-            for feature in new_layer.getFeatures():
-                if feature[new_layer_attribute] in old_attr_set:
-                    sink.addFeature(feature, QgsFeatureSink.FastInsert)
-                    count += 1
-        elif selection_option == 1:  # Select features in the old layer that are not in the new layer
-            for feature in old_layer.getFeatures():
-                if feature[old_layer_attribute] not in new_attr_set:
-                    sink.addFeature(feature, QgsFeatureSink.FastInsert)
-                    count += 1
-        elif selection_option == 2:  # Select features in the new layer that are not in the old layer
-            for feature in new_layer.getFeatures():
-                if feature[new_layer_attribute] not in old_attr_set:
+        if match_mode != self.MATCH_ATTRIBUTE:
+            count = self.spatial_compare(old_layer, new_layer, selection_option, match_mode, tolerance, min_ratio,
+                                         sink, workers, chunk_size, context, feedback)
+        else:
+            def make_select():
+                return lambda feature: feature if (feature[probe_attribute] in key_set) == keep_found else None
+            
+            with self.profiler.phase('match and write features'):
+                for feature in self.mapped_features(probe_layer, QgsFeatureRequest(), make_select,
+                                                    workers, chunk_size, feedback):
                     sink.addFeature(feature, QgsFeatureSink.FastInsert)
                     count += 1
         
+        self.profiler.count('features written', count)
+
         # Log the number of selected features
         feedback.pushInfo(f"Number of features selected: {count}")
         
         # Return the output layer as a result
         return {self.OUTPUT_LAYER: dest_id}
     
+    def spatial_compare(self, old_layer, new_layer, selection_option, match_mode, tolerance, min_ratio,
+                        sink, workers, chunk_size, context, feedback):
+        """Match by geometry: index the smaller layer, stream the larger one past it."""
+        output_layer = old_layer if selection_option == 1 else new_layer
+        other_layer = new_layer if output_layer is old_layer else old_layer
+        want_matched = selection_option == 0
+        
+        if output_layer.featureCount() <= other_layer.featureCount():
+            indexed_layer, streamed_layer = output_layer, other_layer
+        else:
+            indexed_layer, streamed_layer = other_layer, output_layer
+        
+        # The index keeps the geometries too, so candidates never have to be fetched back from the provider
+        with self.profiler.phase('build spatial index'):
+            index = QgsSpatialIndex(
+                indexed_layer.getFeatures(QgsFeatureRequest().setNoAttributes()),
+                feedback,
+                QgsSpatialIndex.FlagStoreFeatureGeometries
+            )
+        self.profiler.count('features read', indexed_layer.featureCount())
+        
+        transform = None
+        if streamed_layer.crs() != indexed_layer.crs():
+            transform = QgsCoordinateTransform(streamed_layer.crs(), indexed_layer.crs(), context.transformContext())
+        
+        count = 0
+        
+        if streamed_layer is output_layer:
+            # Write straight from the stream - one match is enough to decide
+            def make_select():
+                # transforms are not safe to share between threads, so every chunk gets its own copy
+                chunk_transform = QgsCoordinateTransform(transform) if transform else None
+                
+                def select(feature):
+                    matched = bool(self.find_matches(feature.geometry(), index, chunk_transform, match_mode,
+                                                     tolerance, min_ratio, first_only=True))
+                    return feature if matched == want_matched else None
+                return select
+            
+            with self.profiler.phase('match and write features'):
+                for feature in self.mapped_features(streamed_layer, QgsFeatureRequest(), make_select,
+                                                    workers, chunk_size, feedback):
+                    sink.addFeature(feature, QgsFeatureSink.FastInsert)
+                    count += 1
+            return count
+        
+        # The output is the indexed layer - collect its matched ids first, then write from it
+        matched_ids = set()
+        
+        def make_match():
+            chunk_transform = QgsCoordinateTransform(transform) if transform else None
+            return lambda feature: self.find_matches(feature.geometry(), index, chunk_transform, match_mode,
+                                                     tolerance, min_ratio, skip=matched_ids) or None
+        
+        with self.profiler.phase('match features'):
+            for fids in self.mapped_features(streamed_layer, QgsFeatureRequest().setNoAttributes(), make_match,
+                                             workers, chunk_size, feedback):
+                matched_ids.update(fids)
+        
+        with self.profiler.phase('write features'):
+            if want_matched:
+                request = QgsFeatureRequest().setFilterFids(sorted(matched_ids))
+            else:
+                request = QgsFeatureRequest()
+            for feature in indexed_layer.getFeatures(request):
+                if feedback.isCanceled():
+                    break
+                if want_matched or feature.id() not in matched_ids:
+                    sink.addFeature(feature, QgsFeatureSink.FastInsert)
+                    count += 1
+        return count
+    
+    def mapped_features(self, layer, request, make_func, workers, chunk_size, feedback):
+        """Yield func(feature) for the layer's features, skipping None, where func = make_func().
+        
+        With more than one worker the layer is split into feature id chunks, each read on a worker thread
+        through its own feature source and request, with its own func. Results come back in chunk order.
+        """
+        total = layer.featureCount() or 1
+        
+        if workers <= 1:
+            func = make_func()
+            current = -1
+            for current, feature in enumerate(layer.getFeatures(request)):
+                if feedback.isCanceled():
+                    break
+                result = func(feature)
+                if result is not None:
+                    yield result
+                if current % 1000 == 0:
+                    feedback.setProgress(int(current * 100 / total))
+            self.profiler.count('features read', current + 1)
+            return
+        
+        fids = sorted(layer.allFeatureIds())
+        chunks = [fids[i:i + chunk_size] for i in range(0, len(fids), chunk_size)]
+        
+        def run_chunk(source, chunk):
+            func = make_func()
+            results = []
+            for feature in source.getFeatures(QgsFeatureRequest(request).setFilterFids(chunk)):
+                if feedback.isCanceled():
+                    break
+                result = func(feature)
+                if result is not None:
+                    results.append((feature.id(), result))
+            # providers don't promise to return a fid filter in order
+            results.sort(key=lambda item: item[0])
+            return [result for _, result in results]
+        
+        done = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            next_chunk = 0
+            while next_chunk < len(chunks) or pending:
+                # Only a couple of chunks per worker in flight, so finished results never pile up in memory
+                while next_chunk < len(chunks) and len(pending) < workers * 2 and not feedback.isCanceled():
+                    chunk = chunks[next_chunk]
+                    pending.append((executor.submit(run_chunk, QgsVectorLayerFeatureSource(layer), chunk), len(chunk)))
+                    next_chunk += 1
+                if not pending:
+                    break
+                
+                future, chunk_length = pending.popleft()
+                results = future.result()
+                if feedback.isCanceled():
+                    for waiting, _ in pending:
+                        waiting.cancel()
+                    break
+                
+                yield from results
+                done += chunk_length
+                feedback.setProgress(int(done * 100 / total))
+        
+        self.profiler.count('features read', done)
+    
+    def find_matches(self, geometry, index, transform, match_mode, tolerance, min_ratio, skip=None, first_only=False):
+        """Ids of the indexed features that match the geometry, checking only the bounding box candidates."""
+        if geometry is None or geometry.isEmpty():
+            return []
+        if transform:
+            geometry = QgsGeometry(geometry)
+            geometry.transform(transform)
+        
+        rect = geometry.boundingBox()
+        if match_mode == self.MATCH_TOLERANCE:
+            rect.grow(tolerance)
+        
+        engine = None
+        area = 0
+        if match_mode == self.MATCH_OVERLAP:
+            # Prepared once per streamed feature, reused against every candidate
+            engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+            engine.prepareGeometry()
+            area = geometry.area()
+        
+        matches = []
+        for fid in index.intersects(rect):
+            if skip and fid in skip:
+                continue
+            candidate = index.geometry(fid)
+            if match_mode == self.MATCH_EQUAL:
+                matched = geometry.isGeosEqual(candidate)
+            elif match_mode == self.MATCH_TOLERANCE:
+                matched = geometry.hausdorffDistance(candidate) <= tolerance
+            else:
+                if not engine.intersects(candidate.constGet()):
+                    continue
+                shared = engine.intersection(candidate.constGet())
+                shared_area = shared.area() if shared else 0
+                combined_area = area + candidate.area() - shared_area
+                matched = combined_area > 0 and shared_area / combined_area >= min_ratio
+            if matched:
+                matches.append(fid)
+                if first_only:
+                    break
+        return matches
+    
     def name(self):
         return 'compare_layers'
     
@@ -0,0 +1,7 @@
+# Lets this folder be installed as a QGIS plugin, putting all the toolbox scripts under one "Johan Scripts" provider.
+# The scripts still work on their own through "Add Script" too.
+
+
+def classFactory(iface):
+    from .johan_provider import JohanScriptsPlugin
+    return JohanScriptsPlugin(iface)
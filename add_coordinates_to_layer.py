@@ -1,3 +1,4 @@
+import hashlib
 import os
 from qgis.core import (
     QgsProject,
@@ -15,10 +16,37 @@ from qgis.core import (
     QgsVectorFileWriter,
     QgsWkbTypes,
     QgsProcessingParameterFeatureSink,
-    QgsProcessing
+    QgsProcessingParameterNumber,
+    QgsProcessing,
+    QgsFeatureRequest,
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsCsException,
+    QgsLineString,
+    QgsEditorWidgetSetup,
+    NULL
 )
 from qgis.PyQt.QtCore import QVariant
 
+try:
+    from .johan_profiler import add_profile_parameter, profiled
+except ImportError:
+    # Added through "Add Script" - QGIS puts its scripts folder on sys.path, so johan_profiler.py has to go there too
+    from johan_profiler import add_profile_parameter, profiled
+
+# Coordinate field pairs written for each geometry type, in the layer's own CRS
+COORDINATE_PAIRS = {
+    QgsWkbTypes.PointGeometry: [("x", "y")],
+    QgsWkbTypes.LineGeometry: [("start_x", "start_y"), ("end_x", "end_y")],
+    QgsWkbTypes.PolygonGeometry: [("mid1_x", "mid1_y"), ("mid2_x", "mid2_y")],
+}
+
+# Features transformed and written per provider call
+WRITE_BATCH = 10000
+
+# Geometry fingerprint from the last run, for incremental runs
+HASH_FIELD = "geom_hash"
+
 class AddCoordinatesToLayer(QgsProcessingAlgorithm):
 
     LAYER = 'LAYER'
@@ -26,6 +54,10 @@ class AddCoordinatesToLayer(QgsProcessingAlgorithm):
     OVERWRITE_EXISTING_ATTRIBUTES = 'OVERWRITE_EXISTING_ATTRIBUTES'
     CREATE_NEW_LAYER = 'CREATE_NEW_LAYER'
     POLY_TRENCH_ENDS_ONLY = 'POLY_TRENCH_ENDS_ONLY'
+    EXTRA_CRS = 'EXTRA_CRS'
+    PROJECTED_DECIMALS = 'PROJECTED_DECIMALS'
+    GEOGRAPHIC_DECIMALS = 'GEOGRAPHIC_DECIMALS'
+    INCREMENTAL = 'INCREMENTAL'
 
     def initAlgorithm(self, config=None):
         self.addParameter(
@@ -60,16 +92,97 @@ class AddCoordinatesToLayer(QgsProcessingAlgorithm):
             )
         )
 
-    def define_fields(self, layer, overwrite_existing):
-        geometry_type = layer.geometryType()
-        fields_to_add = []
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.EXTRA_CRS,
+                'Also write coordinates in these CRSs (comma separated, e.g. EPSG:27700, EPSG:4326)',
+                defaultValue='',
+                optional=True
+            )
+        )
 
-        if geometry_type == QgsWkbTypes.PointGeometry:
-            fields_to_add = ["x", "y"]
-        elif geometry_type == QgsWkbTypes.LineGeometry:
-            fields_to_add = ["start_x", "start_y", "end_x", "end_y"]
-        elif geometry_type == QgsWkbTypes.PolygonGeometry:
-            fields_to_add = ["mid1_x", "mid1_y", "mid2_x", "mid2_y"]
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.PROJECTED_DECIMALS,
+                'Decimal places for projected coordinates (blank for no rounding)',
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                maxValue=15,
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.GEOGRAPHIC_DECIMALS,
+                'Decimal places for lat/lon coordinates (blank for no rounding)',
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                maxValue=15,
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.INCREMENTAL,
+                'Only update features whose geometry changed since the last run, or whose coordinates are empty',
+                defaultValue=False
+            )
+        )
+
+        add_profile_parameter(self)
+
+    def decimals(self, parameters, name, context):
+        """Decimal places asked for, or None when left blank."""
+        if parameters.get(name) in (None, ''):
+            return None
+        return self.parameterAsInt(parameters, name, context)
+
+    def coordinate_sets(self, layer, geometry_type, extra_crs, projected_decimals, geographic_decimals, context):
+        """(transform, decimals, field name pairs) for the layer's own CRS and every extra CRS asked for."""
+        pairs = COORDINATE_PAIRS.get(geometry_type, [])
+        layer_decimals = geographic_decimals if layer.crs().isGeographic() else projected_decimals
+        sets = [(None, layer_decimals, pairs)]
+
+        for authid in extra_crs.replace(';', ',').split(','):
+            authid = authid.strip()
+            if not authid:
+                continue
+            crs = QgsCoordinateReferenceSystem(authid)
+            if not crs.isValid():
+                raise QgsProcessingException(f'Unknown CRS "{authid}"')
+            if crs == layer.crs():
+                continue  # already written as the plain x/y fields
+
+            if crs.isGeographic():
+                # start_x -> start_lon, start_y -> start_lat
+                names = [(x[:-1] + "lon", y[:-1] + "lat") for x, y in pairs]
+                decimals = geographic_decimals
+            else:
+                # start_x -> sx_27700 - short enough for a shapefile's 10 character field names
+                code = crs.authid().split(':')[-1]
+                names = [(self.short_name(x, code), self.short_name(y, code)) for x, y in pairs]
+                if any(len(name) > 10 for pair in names for name in pair):
+                    raise QgsProcessingException(f'The code of {crs.authid()} is too long to fit in a field name - use an EPSG code')
+                decimals = projected_decimals
+
+            # One transform per CRS for the whole run
+            transform = QgsCoordinateTransform(layer.crs(), crs, context.transformContext())
+            sets.append((transform, decimals, names))
+
+        all_names = [name for _, _, names in sets for pair in names for name in pair]
+        if len(all_names) != len(set(all_names)):
+            raise QgsProcessingException('Two of the CRSs would write to the same fields - only list one geographic CRS')
+        return sets
+
+    def short_name(self, name, code):
+        """Field name for a projected CRS: start_x -> sx_27700, mid1_y -> m1y_27700, x -> x_27700."""
+        prefix, _, axis = name.rpartition('_')
+        return prefix[:1] + ''.join(c for c in prefix if c.isdigit()) + axis + '_' + code
+
+    def define_fields(self, layer, overwrite_existing, coordinate_sets):
+        fields_to_add = [name for _, _, names in coordinate_sets for pair in names for name in pair]
 
         existing_fields = {field.name(): field for field in layer.fields()}
         fields_to_use = {}
@@ -100,6 +213,27 @@ class AddCoordinatesToLayer(QgsProcessingAlgorithm):
                 layer_provider.addAttributes([QgsField(new_name, QVariant.Double)])
         layer.updateFields()
 
+    def add_hash_field(self, layer):
+        """Add the geometry fingerprint field if it isn't there yet.
+
+        It is hidden from the attribute form every run, but that is kept in the project, not the file - other projects show it.
+        """
+        if HASH_FIELD not in layer.fields().names():
+            layer.dataProvider().addAttributes([QgsField(HASH_FIELD, QVariant.String, len=16)])
+            layer.updateFields()
+        hash_index = layer.fields().lookupField(HASH_FIELD)
+        if hash_index == -1:
+            raise QgsProcessingException(f'Field {HASH_FIELD} could not be added to {layer.name()}')
+        layer.setEditorWidgetSetup(hash_index, QgsEditorWidgetSetup('Hidden', {}))
+        return hash_index
+
+    def geometry_hash(self, settings, geom):
+        """8 byte fingerprint of the geometry and the settings it was written with, as 16 hex characters."""
+        digest = hashlib.blake2b(settings, digest_size=8)
+        if geom is not None:
+            digest.update(bytes(geom.asWkb()))
+        return digest.hexdigest()
+
     def get_centroid(self, feature):
         geom = feature.geometry()
         return geom.centroid().asPoint()
@@ -116,6 +250,141 @@ class AddCoordinatesToLayer(QgsProcessingAlgorithm):
         else:
             return geom.asPolyline()[-1]
     
+    def coordinate_points(self, geom, geometry_type, poly_trench_ends_only):
+        """The points to write for one feature, in the same order as COORDINATE_PAIRS, or None to skip it."""
+        if geom is None or geom.isEmpty():
+            return None
+        if geometry_type == QgsWkbTypes.PointGeometry:
+            return [geom.asPoint()]
+        if geometry_type == QgsWkbTypes.LineGeometry:
+            return [self.get_start_point(geom), self.get_end_point(geom)]
+        if geometry_type == QgsWkbTypes.PolygonGeometry and poly_trench_ends_only:
+            return self.get_shortest_side_midpoints(geom)
+        return None
+
+    def field_indexes(self, layer, coordinate_sets, fields_to_use):
+        """Field index pairs for each coordinate set, None where the fields are being left alone."""
+        fields = layer.fields()
+        indexes = []
+        for _, _, names in coordinate_sets:
+            set_indexes = []
+            for x, y in names:
+                if x in fields_to_use and y in fields_to_use:
+                    pair = (fields.lookupField(x), fields.lookupField(y))
+                    if -1 in pair:
+                        # The provider renamed or refused the field, e.g. cut it to fit a shapefile
+                        raise QgsProcessingException(f'Fields {x} and {y} could not be added to {layer.name()}')
+                    set_indexes.append(pair)
+                else:
+                    set_indexes.append(None)
+            indexes.append(set_indexes)
+        return indexes
+
+    def transform_batch(self, transform, xs, ys):
+        """Transform a whole batch of coordinates at once, as the vertices of one line."""
+        line = QgsLineString(xs, ys)
+        try:
+            line.transform(transform)
+        except QgsCsException:
+            # One point outside the CRS area fails the lot - redo them one at a time and leave the bad ones empty
+            out_xs, out_ys = [], []
+            for x, y in zip(xs, ys):
+                try:
+                    point = transform.transform(QgsPointXY(x, y))
+                    out_xs.append(point.x())
+                    out_ys.append(point.y())
+                except QgsCsException:
+                    out_xs.append(None)
+                    out_ys.append(None)
+            return out_xs, out_ys
+        count = line.numPoints()
+        return [line.xAt(i) for i in range(count)], [line.yAt(i) for i in range(count)]
+
+    def coordinate_values(self, batch_ids, batch_points, coordinate_sets, indexes):
+        """{feature id: {field index: value}} for a batch, every coordinate set in one go."""
+        xs = [point.x() for points in batch_points for point in points]
+        ys = [point.y() for points in batch_points for point in points]
+        values = {fid: {} for fid in batch_ids}
+
+        for (transform, decimals, names), set_indexes in zip(coordinate_sets, indexes):
+            set_xs, set_ys = self.transform_batch(transform, xs, ys) if transform else (xs, ys)
+            if decimals is not None:
+                set_xs = [None if x is None else round(x, decimals) for x in set_xs]
+                set_ys = [None if y is None else round(y, decimals) for y in set_ys]
+
+            position = 0
+            for fid in batch_ids:
+                for pair_indexes in set_indexes:
+                    if pair_indexes is not None:
+                        values[fid][pair_indexes[0]] = set_xs[position]
+                        values[fid][pair_indexes[1]] = set_ys[position]
+                    position += 1
+        return values
+
+    def batched_values(self, layer, geometry_type, poly_trench_ends_only, coordinate_sets, indexes, feedback,
+                       hash_index=None, settings=b''):
+        """Stream the layer's geometries and yield the new attribute values a batch at a time.
+
+        With a hash_index only features whose geometry fingerprint changed, or with empty coordinate fields that could be
+        filled, are yielded, each with its new fingerprint. Features with no coordinates to write still get the fingerprint,
+        so they are skipped next time.
+        """
+        coordinate_indexes = [index for set_indexes in indexes for pair in set_indexes if pair is not None for index in pair]
+        if hash_index is None:
+            request = QgsFeatureRequest().setNoAttributes()
+        else:
+            request = QgsFeatureRequest().setSubsetOfAttributes([hash_index] + coordinate_indexes)
+        total = layer.featureCount() or 1
+        batch_ids, batch_points, batch_hashes = [], [], []
+        hash_only = {}
+        self.skipped = 0
+
+        for current, feature in enumerate(layer.getFeatures(request)):
+            if feedback.isCanceled():
+                break
+            geom = feature.geometry()
+
+            unchanged = False
+            if hash_index is not None:
+                geometry_hash = self.geometry_hash(settings, geom)
+                attributes = feature.attributes()
+                unchanged = attributes[hash_index] == geometry_hash
+                if unchanged and all(
+                        attributes[index] is not None and attributes[index] != NULL for index in coordinate_indexes):
+                    self.skipped += 1
+                    continue
+
+            points = self.coordinate_points(geom, geometry_type, poly_trench_ends_only)
+            if unchanged and points is None:
+                # Empty coordinate fields, but nothing to fill them with
+                self.skipped += 1
+                continue
+
+            if points is not None:
+                batch_ids.append(feature.id())
+                batch_points.append(points)
+                if hash_index is not None:
+                    batch_hashes.append(geometry_hash)
+            elif hash_index is not None:
+                hash_only[feature.id()] = geometry_hash
+
+            if len(batch_ids) + len(hash_only) >= WRITE_BATCH:
+                yield self.batch_with_hashes(batch_ids, batch_points, batch_hashes, hash_only, coordinate_sets, indexes, hash_index)
+                batch_ids, batch_points, batch_hashes = [], [], []
+                hash_only = {}
+                feedback.setProgress(int(current * 100 / total))
+
+        if batch_ids or hash_only:
+            yield self.batch_with_hashes(batch_ids, batch_points, batch_hashes, hash_only, coordinate_sets, indexes, hash_index)
+
+    def batch_with_hashes(self, batch_ids, batch_points, batch_hashes, hash_only, coordinate_sets, indexes, hash_index):
+        values = self.coordinate_values(batch_ids, batch_points, coordinate_sets, indexes)
+        for fid, geometry_hash in zip(batch_ids, batch_hashes):
+            values[fid][hash_index] = geometry_hash
+        for fid, geometry_hash in hash_only.items():
+            values[fid] = {hash_index: geometry_hash}
+        return values
+
     def get_shortest_side_midpoints(self, geom):
         """Identify the two shortest sides of a polygon and return their midpoints."""
         if geom.isMultipart():
@@ -138,11 +407,16 @@ class AddCoordinatesToLayer(QgsProcessingAlgorithm):
 
         return shortest_edges_midpoints
 
+    @profiled
     def processAlgorithm(self, parameters, context, feedback):
         layer = self.parameterAsVectorLayer(parameters, self.LAYER, context)
         overwrite_existing = self.parameterAsBoolean(parameters, self.OVERWRITE_EXISTING_ATTRIBUTES, context)
         create_new_layer = self.parameterAsBoolean(parameters, self.CREATE_NEW_LAYER, context)
         poly_trench_ends_only = self.parameterAsBoolean(parameters, self.POLY_TRENCH_ENDS_ONLY, context)
+        extra_crs = self.parameterAsString(parameters, self.EXTRA_CRS, context)
+        projected_decimals = self.decimals(parameters, self.PROJECTED_DECIMALS, context)
+        geographic_decimals = self.decimals(parameters, self.GEOGRAPHIC_DECIMALS, context)
+        incremental = self.parameterAsBoolean(parameters, self.INCREMENTAL, context)
         
         if not layer:
             raise QgsProcessingException('Layer not found or invalid.')
@@ -155,40 +429,38 @@ class AddCoordinatesToLayer(QgsProcessingAlgorithm):
             geometry_type = QgsWkbTypes.geometryType(wkb_type)
             multi_part_warning = f"Warning: Layer is a multi-part {QgsWkbTypes.displayString(wkb_type)}. Coordinates will be averaged for features with multiple parts."
 
-        fields_to_use = self.define_fields(layer, overwrite_existing)
-        
-        self.add_fields_to_layer(layer, fields_to_use)
+        coordinate_sets = self.coordinate_sets(layer, geometry_type, extra_crs, projected_decimals, geographic_decimals, context)
+
+        with self.profiler.phase('add fields'):
+            fields_to_use = self.define_fields(layer, overwrite_existing, coordinate_sets)
+            self.add_fields_to_layer(layer, fields_to_use)
 
         layer_provider = layer.dataProvider()
 
+        hash_index = None
+        settings = b''
+        if incremental:
+            hash_index = self.add_hash_field(layer)
+            # Changing any of these means every feature needs redoing, so they go into the fingerprint too.
+            # The extra CRSs as parsed, so "epsg:4326; EPSG:27700" and "EPSG:27700,EPSG:4326" are the same settings
+            extra_crs_ids = sorted(
+                transform.destinationCrs().authid() or transform.destinationCrs().toWkt()
+                for transform, _, _ in coordinate_sets if transform is not None
+            )
+            settings = f"{poly_trench_ends_only}|{','.join(extra_crs_ids)}|{projected_decimals}|{geographic_decimals}|".encode()
+
+        indexes = self.field_indexes(layer, coordinate_sets, fields_to_use)
+
         if create_new_layer:
             # Create a new layer
             new_layer = layer.clone()
-            new_layer.startEditing()
-            for feature in new_layer.getFeatures():
-                geom = feature.geometry()
-
-                if geometry_type == QgsWkbTypes.PointGeometry:
-                    point = geom.asPoint()
-                    new_layer.changeAttributeValue(feature.id(), new_layer.fields().lookupField(fields_to_use["x"]), point.x())
-                    new_layer.changeAttributeValue(feature.id(), new_layer.fields().lookupField(fields_to_use["y"]), point.y())
-
-                elif geometry_type == QgsWkbTypes.LineGeometry:
-                    start_point = self.get_start_point(geom)
-                    end_point = self.get_end_point(geom)
-                    new_layer.changeAttributeValue(feature.id(), new_layer.fields().lookupField(fields_to_use["start_x"]), start_point.x())
-                    new_layer.changeAttributeValue(feature.id(), new_layer.fields().lookupField(fields_to_use["start_y"]), start_point.y())
-                    new_layer.changeAttributeValue(feature.id(), new_layer.fields().lookupField(fields_to_use["end_x"]), end_point.x())
-                    new_layer.changeAttributeValue(feature.id(), new_layer.fields().lookupField(fields_to_use["end_y"]), end_point.y())
-
-                elif geometry_type == QgsWkbTypes.PolygonGeometry and poly_trench_ends_only:
-                    midpoints = self.get_shortest_side_midpoints(geom)
-                    new_layer.changeAttributeValue(feature.id(), new_layer.fields().lookupField(fields_to_use["mid1_x"]), midpoints[0].x())
-                    new_layer.changeAttributeValue(feature.id(), new_layer.fields().lookupField(fields_to_use["mid1_y"]), midpoints[0].y())
-                    new_layer.changeAttributeValue(feature.id(), new_layer.fields().lookupField(fields_to_use["mid2_x"]), midpoints[1].x())
-                    new_layer.changeAttributeValue(feature.id(), new_layer.fields().lookupField(fields_to_use["mid2_y"]), midpoints[1].y())
-
-            new_layer.commitChanges()
+            with self.profiler.phase('write coordinates'):
+                new_layer.startEditing()
+                for values in self.batched_values(new_layer, geometry_type, poly_trench_ends_only, coordinate_sets, indexes, feedback,
+                                                  hash_index, settings):
+                    for fid, feature_values in values.items():
+                        new_layer.changeAttributeValues(fid, feature_values)
+                new_layer.commitChanges()
 
             # Determine the output filename
             input_path = layer.dataProvider().dataSourceUri().split('|')[0]
@@ -202,7 +474,11 @@ class AddCoordinatesToLayer(QgsProcessingAlgorithm):
                 count += 1
 
             # Save the new layer
-            QgsVectorFileWriter.writeAsVectorFormat(new_layer, output_path, "utf-8", new_layer.crs(), "ESRI Shapefile")
+            with self.profiler.phase('save new layer'):
+                QgsVectorFileWriter.writeAsVectorFormat(new_layer, output_path, "utf-8", new_layer.crs(), "ESRI Shapefile")
+
+            self.profiler.count('features written', new_layer.featureCount())
+            self.profiler.file_written(output_path)
 
             # Add the new layer to the project
             new_layer_loaded = QgsVectorLayer(output_path, os.path.basename(output_path), "ogr")
@@ -213,40 +489,22 @@ class AddCoordinatesToLayer(QgsProcessingAlgorithm):
 
             return {self.OUTPUT_LAYER: output_path}
         else:
-            # Modify the existing layer
-            for feature in layer.getFeatures():
-                geom = feature.geometry()
-
-                if geometry_type == QgsWkbTypes.PointGeometry:
-                    point = geom.asPoint()
-                    layer_provider.changeAttributeValues({
-                        feature.id(): {layer.fields().lookupField(fields_to_use["x"]): point.x(),
-                                       layer.fields().lookupField(fields_to_use["y"]): point.y()}
-                    })
-
-                elif geometry_type == QgsWkbTypes.LineGeometry:
-                    start_point = self.get_start_point(geom)
-                    end_point = self.get_end_point(geom)
-                    layer_provider.changeAttributeValues({
-                        feature.id(): {layer.fields().lookupField(fields_to_use["start_x"]): start_point.x(),
-                                       layer.fields().lookupField(fields_to_use["start_y"]): start_point.y(),
-                                       layer.fields().lookupField(fields_to_use["end_x"]): end_point.x(),
-                                       layer.fields().lookupField(fields_to_use["end_y"]): end_point.y()}
-                    })
-
-                elif geometry_type == QgsWkbTypes.PolygonGeometry and poly_trench_ends_only:
-                    midpoints = self.get_shortest_side_midpoints(geom)
-                    layer_provider.changeAttributeValues({
-                        feature.id(): {layer.fields().lookupField(fields_to_use["mid1_x"]): midpoints[0].x(),
-                                       layer.fields().lookupField(fields_to_use["mid1_y"]): midpoints[0].y(),
-                                       layer.fields().lookupField(fields_to_use["mid2_x"]): midpoints[1].x(),
-                                       layer.fields().lookupField(fields_to_use["mid2_y"]): midpoints[1].y()}
-                    })
-
-            layer.commitChanges()
+            # Modify the existing layer, one provider call per batch
+            with self.profiler.phase('write coordinates'):
+                for values in self.batched_values(layer, geometry_type, poly_trench_ends_only, coordinate_sets, indexes, feedback,
+                                                  hash_index, settings):
+                    layer_provider.changeAttributeValues(values)
+
+                layer.commitChanges()
+
+            self.profiler.count('features written', layer.featureCount() - self.skipped)
+            if incremental:
+                self.profiler.count('features skipped', self.skipped)
+                feedback.pushInfo(f"Unchanged features skipped: {self.skipped}")
 
             # Clean up empty fields that were created
-            self.cleanup_empty_fields(layer, fields_to_use)
+            with self.profiler.phase('clean up empty fields'):
+                self.cleanup_empty_fields(layer, fields_to_use)
 
             if multi_part_warning:
                 feedback.pushInfo(multi_part_warning)
@@ -259,8 +517,9 @@ class AddCoordinatesToLayer(QgsProcessingAlgorithm):
         fields_to_remove = []
 
         for field_name in fields_to_use.values():
-            if self.is_field_empty(layer, field_name):
-                fields_to_remove.append(layer.fields().indexOf(field_name))
+            index = layer.fields().indexOf(field_name)
+            if index != -1 and self.is_field_empty(layer, field_name):
+                fields_to_remove.append(index)
 
         if fields_to_remove:
             layer_provider.deleteAttributes(fields_to_remove)
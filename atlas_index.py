@@ -0,0 +1,126 @@
+"""
+Sheet index for the atlas.shp that Create Layout Extent Polygon builds up.
+
+The order, scale and bounding box of every sheet are kept in a JSON file next to the atlas (atlas_index.json),
+so looking up which sheets cover something never has to read the shapefile. Create Layout Extent Polygon adds
+each new sheet to it as it goes. The file is only the list of boxes - the R-tree over them is built in memory
+from it on every run (sheet_rtree), which for an atlas of a few thousand sheets takes no time at all. If the atlas has been changed any other way (edited, sheets deleted, a different
+file copied over it) the index no longer matches the file and is rebuilt from the atlas the next time it is loaded.
+
+Sheets are unrotated map extents, so a sheet's bounding box is the sheet.
+"""
+import json
+import os
+
+from qgis.core import NULL, QgsCoordinateReferenceSystem, QgsFeatureRequest, QgsRectangle, QgsSpatialIndex, QgsVectorLayer
+
+INDEX_SUFFIX = '_index.json'
+
+
+def index_path(atlas_path):
+    return os.path.splitext(atlas_path)[0] + INDEX_SUFFIX
+
+
+def file_stamp(atlas_path):
+    """Modified time and size of the files that hold the sheets - if these change, so might the sheets."""
+    base = os.path.splitext(atlas_path)[0]
+    stamp = []
+    for extension in ('.shp', '.dbf'):
+        path = base + extension
+        if os.path.exists(path):
+            info = os.stat(path)
+            stamp.append([extension, info.st_mtime_ns, info.st_size])
+    return stamp
+
+
+def read_index(atlas_path):
+    """The saved index, or None if there isn't one or it no longer matches the atlas."""
+    path = index_path(atlas_path)
+    if not os.path.exists(path) or not os.path.exists(atlas_path):
+        return None
+    try:
+        with open(path, encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get('stamp') != file_stamp(atlas_path) or index.get('count') != len(index.get('sheets', [])):
+        return None
+    return index
+
+
+def write_index(atlas_path, index):
+    """Save the index against the atlas as it is now, via a temp file so a crash never leaves half an index."""
+    index['stamp'] = file_stamp(atlas_path)
+    index['count'] = len(index['sheets'])
+    path = index_path(atlas_path)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(temp_path, path)
+
+
+def _plain(value):
+    """NULL attributes as None, so they can go into JSON."""
+    return None if value is None or value == NULL else value
+
+
+def sheet_entry(order, scale, rect):
+    return {
+        'order': _plain(order),
+        'scale': None if _plain(scale) is None else str(scale),
+        'bbox': [rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum()],
+    }
+
+
+def build_index(atlas_path):
+    """Read every sheet from the atlas and save a fresh index."""
+    layer = QgsVectorLayer(atlas_path, 'atlas', 'ogr')
+    if not layer.isValid():
+        raise ValueError(f'Failed to load atlas layer: {atlas_path}')
+
+    fields = layer.fields()
+    request = QgsFeatureRequest().setSubsetOfAttributes(['order', 'scale'], fields)
+    sheets = []
+    for feature in layer.getFeatures(request):
+        geometry = feature.geometry()
+        if geometry is None or geometry.isEmpty():
+            continue
+        sheets.append(sheet_entry(feature['order'], feature['scale'], geometry.boundingBox()))
+
+    index = {'crs': layer.crs().toWkt(), 'sheets': sheets}
+    del layer  # let go of the files before stamping them
+    write_index(atlas_path, index)
+    return index
+
+
+def load_index(atlas_path):
+    """The saved index if it is up to date, otherwise a rebuilt one."""
+    return read_index(atlas_path) or build_index(atlas_path)
+
+
+def append_sheet(atlas_path, index, order, scale, rect):
+    """Add a sheet that has just been written to the atlas.
+
+    index is the index read before the atlas was written. If there wasn't an up to date one the whole atlas is
+    indexed instead.
+    """
+    if index is None:
+        return build_index(atlas_path)
+    index['sheets'].append(sheet_entry(order, scale, rect))
+    write_index(atlas_path, index)
+    return index
+
+
+def index_crs(index):
+    return QgsCoordinateReferenceSystem.fromWkt(index['crs'])
+
+
+def sheet_rtree(index):
+    """In-memory R-tree over the sheets. Ids are positions in index['sheets']."""
+    rtree = QgsSpatialIndex()
+    rects = []
+    for position, sheet in enumerate(index['sheets']):
+        rect = QgsRectangle(*sheet['bbox'])
+        rtree.addFeature(position, rect)
+        rects.append(rect)
+    return rtree, rects
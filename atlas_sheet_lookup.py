@@ -0,0 +1,183 @@
+import os
+from qgis.core import (
+    QgsProject,
+    QgsField,
+    QgsFields,
+    QgsFeature,
+    QgsFeatureSink,
+    QgsGeometry,
+    QgsCoordinateTransform,
+    QgsCsException,
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterFile,
+    QgsProcessingParameterString,
+    QgsProcessingParameterFeatureSink,
+    QgsProcessingException
+)
+from qgis.PyQt.QtCore import QVariant
+
+try:
+    from . import atlas_index
+    from .johan_profiler import add_profile_parameter, profiled
+except ImportError:
+    # Added through "Add Script" - QGIS puts its scripts folder on sys.path, so both have to go there too
+    import atlas_index
+    from johan_profiler import add_profile_parameter, profiled
+
+class AtlasSheetLookup(QgsProcessingAlgorithm):
+
+    INPUT = 'INPUT'
+    ATLAS = 'ATLAS'
+    SHEETS_FIELD = 'SHEETS_FIELD'
+    OUTPUT = 'OUTPUT'
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.INPUT,
+                'Features to tag',
+                [QgsProcessing.TypeVectorAnyGeometry]
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.ATLAS,
+                'Atlas layer (blank for atlas.shp in the project folder)',
+                extension='shp',
+                optional=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.SHEETS_FIELD,
+                'Field name for the sheet orders (the scales go in <name>_scl)',
+                defaultValue='sheets'
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT,
+                'Tagged features',
+                QgsProcessing.TypeVectorAnyGeometry
+            )
+        )
+
+        add_profile_parameter(self)
+
+    @profiled
+    def processAlgorithm(self, parameters, context, feedback):
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        atlas_path = self.parameterAsFile(parameters, self.ATLAS, context)
+        sheets_field = self.parameterAsString(parameters, self.SHEETS_FIELD, context).strip()
+        scales_field = f'{sheets_field}_scl'
+        output_path = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
+
+        if source is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
+        if not atlas_path:
+            atlas_path = os.path.join(QgsProject.instance().homePath(), 'atlas.shp')
+        if not os.path.exists(atlas_path):
+            raise QgsProcessingException(f'No atlas found at {atlas_path} - make some sheets with Create Layout Extent Polygon first')
+
+        for name in (sheets_field, scales_field):
+            if source.fields().lookupField(name) != -1:
+                raise QgsProcessingException(f'The input already has a "{name}" field - choose another field name')
+            if output_path.lower().endswith('.shp') and len(name) > 10:
+                raise QgsProcessingException(f'"{name}" is too long for a shapefile field - use a sheet field name of 6 characters or fewer')
+
+        # The saved sheet boxes if Create Layout Extent Polygon kept them up to date, otherwise they are re-read once here.
+        # Either way the R-tree over them is built in memory for this run
+        with self.profiler.phase('load sheet index'):
+            try:
+                index = atlas_index.load_index(atlas_path)
+            except ValueError as e:
+                raise QgsProcessingException(str(e))
+            rtree, rects = atlas_index.sheet_rtree(index)
+        sheets = index['sheets']
+        feedback.pushInfo(f"Atlas sheets indexed: {len(sheets)}")
+
+        transform = None
+        atlas_crs = atlas_index.index_crs(index)
+        if source.sourceCrs() != atlas_crs:
+            transform = QgsCoordinateTransform(source.sourceCrs(), atlas_crs, context.transformContext())
+
+        fields = QgsFields(source.fields())
+        fields.append(QgsField(sheets_field, QVariant.String))
+        fields.append(QgsField(scales_field, QVariant.String))
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context, fields, source.wkbType(), source.sourceCrs())
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+
+        # One pass over the input, each feature only tested against the sheets whose box it touches
+        total = source.featureCount() or 1
+        current = -1
+        tagged = 0
+        with self.profiler.phase('tag features'):
+            for current, feature in enumerate(source.getFeatures()):
+                if feedback.isCanceled():
+                    break
+
+                covering = []
+                geom = feature.geometry()
+                if geom is not None and not geom.isEmpty():
+                    if transform:
+                        geom = QgsGeometry(geom)
+                        try:
+                            geom.transform(transform)
+                        except QgsCsException:
+                            geom = None
+                    if geom is not None:
+                        covering = sorted(
+                            (position for position in rtree.intersects(geom.boundingBox()) if geom.intersects(rects[position])),
+                            key=lambda position: (sheets[position]['order'] is None, sheets[position]['order'])
+                        )
+
+                tagged_feature = QgsFeature(fields)
+                tagged_feature.setGeometry(feature.geometry())
+                if covering:
+                    tagged += 1
+                    tagged_feature.setAttributes(feature.attributes() + [
+                        ';'.join(self.text(sheets[position]['order']) for position in covering),
+                        ';'.join(self.text(sheets[position]['scale']) for position in covering)
+                    ])
+                else:
+                    tagged_feature.setAttributes(feature.attributes() + [None, None])
+                sink.addFeature(tagged_feature, QgsFeatureSink.FastInsert)
+
+                if current % 1000 == 0:
+                    feedback.setProgress(int(current * 100 / total))
+
+        self.profiler.count('features read', current + 1)
+        self.profiler.count('features written', current + 1)
+
+        feedback.pushInfo(f"Features on at least one sheet: {tagged} of {current + 1}")
+
+        return {self.OUTPUT: dest_id}
+
+    def text(self, value):
+        """A sheet's order or scale for the lists, empty if the sheet has none."""
+        return '' if value is None else str(value)
+
+    def name(self):
+        return 'atlas_sheet_lookup'
+
+    def displayName(self):
+        return 'Tag Features with Atlas Sheets'
+
+    def group(self):
+        return 'Johan Scripts'
+
+    def groupId(self):
+        return 'johan_scripts'
+
+    def createInstance(self):
+        return AtlasSheetLookup()
+
+# Ensure the algorithm is recognized by QGIS when adding it via the "Add Script" tool
+def classFactory(iface):
+    return AtlasSheetLookup()
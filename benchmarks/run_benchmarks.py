@@ -0,0 +1,333 @@
+"""
+Offline benchmarks for the Johan Scripts algorithms.
+
+Runs every algorithm headless in a standalone QgsApplication against synthetic GeoPackages (see synthetic_data.py)
+and appends wall time, peak RSS and features/sec to a JSON history, flagging anything slower than the last run.
+
+python benchmarks/run_benchmarks.py                          all cases at 10k and 100k
+python benchmarks/run_benchmarks.py --sizes 10000 1000000 10000000 --cases compare_layers
+python benchmarks/run_benchmarks.py --list
+python benchmarks/run_benchmarks.py --cases compare_layers --profile cprofile,trace
+
+Each case runs in its own python process so peak RSS belongs to that case alone.
+Set QGIS_PREFIX_PATH if QGIS is not installed under /usr.
+"""
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+DEFAULT_DATA_DIR = os.path.join(BENCHMARK_DIR, 'data')
+DEFAULT_HISTORY = os.path.join(BENCHMARK_DIR, 'history.json')
+DEFAULT_SIZES = [10000, 100000]
+
+
+# name -> (script file, algorithm class, largest size worth running, what size counts)
+CASES = {
+    'compare_layers': ('Compare_Layers_by_Attribute.py', 'CompareLayersAlgorithm', 10000000, 'features'),
+    'compare_layers_parallel': ('Compare_Layers_by_Attribute.py', 'CompareLayersAlgorithm', 10000000, 'features'),
+    'add_coordinates_points': ('add_coordinates_to_layer.py', 'AddCoordinatesToLayer', 10000000, 'features'),
+    'add_coordinates_lines': ('add_coordinates_to_layer.py', 'AddCoordinatesToLayer', 10000000, 'features'),
+    'add_coordinates_trenches': ('add_coordinates_to_layer.py', 'AddCoordinatesToLayer', 10000000, 'features'),
+    'concentric_donut_buffers': ('concentric_donut_buffers.py', 'ConcentricDonutBuffers', 1000000, 'vertices'),
+    'layout_extent_polygon': ('layout_extent_polygon.py', 'CreateLayoutExtentPolygon', 100000, 'existing sheets'),
+    'bulk_regex_field_rewrite': ('bulk_regex_field_rewrite.py', 'BulkRegexFieldRewrite', 10000000, 'features'),
+    'atlas_sheet_lookup': ('atlas_sheet_lookup.py', 'AtlasSheetLookup', 10000000, 'features'),
+    'vacuum_geopackage': ('reduce_gpkg_size.py', None, 10000000, 'features'),
+}
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far, or None if the platform can't tell us."""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 1048576
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1048576 if sys.platform == 'darwin' else peak / 1024
+
+
+def load_script(file_name):
+    path = os.path.join(REPO_DIR, file_name)
+    module_name = os.path.splitext(file_name)[0]
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def start_qgis():
+    from qgis.core import QgsApplication
+    QgsApplication.setPrefixPath(os.environ.get('QGIS_PREFIX_PATH', '/usr'), True)
+    app = QgsApplication([], False)
+    app.initQgis()
+
+    # the processing plugin lives with the QGIS python plugins, not on the normal path
+    sys.path.append(os.path.join(QgsApplication.pkgDataPath(), 'python', 'plugins'))
+    from processing.core.Processing import Processing
+    Processing.initialize()
+    return app
+
+
+def copy_gpkg(source, work_dir):
+    """Algorithms that edit in place get a fresh copy, so every run starts from the same data."""
+    target = os.path.join(work_dir, os.path.basename(source))
+    shutil.copyfile(source, target)
+    return target
+
+
+def setup_case(case, size, data_dir, work_dir):
+    """Build the parameters for one run. Anything done here is not timed."""
+    import synthetic_data as data
+    from qgis.core import QgsProcessing
+
+    if case.startswith('compare_layers'):
+        old = data.cached(data_dir, f'points_{size}_old.gpkg', data.points, size, 1, 0)
+        new = data.cached(data_dir, f'points_{size}_new.gpkg', data.points, size, 1, size // 10)
+        return {
+            'OLD_LAYER': old, 'NEW_LAYER': new,
+            'OLD_LAYER_ATTRIBUTE': 'uid', 'NEW_LAYER_ATTRIBUTE': 'uid',
+            'SELECTION_OPTION': 2, 'OUTPUT_LAYER': QgsProcessing.TEMPORARY_OUTPUT,
+            'PARALLEL_WORKERS': 4 if case == 'compare_layers_parallel' else 1,
+        }
+
+    if case.startswith('add_coordinates'):
+        make = {'points': data.points, 'lines': data.lines, 'trenches': data.trenches}[case.rsplit('_', 1)[1]]
+        source = data.cached(data_dir, f'{case.rsplit("_", 1)[1]}_{size}.gpkg', make, size)
+        return {
+            'LAYER': copy_gpkg(source, work_dir),
+            'OVERWRITE_EXISTING_ATTRIBUTES': True,
+            'CREATE_NEW_LAYER': False,
+            'POLY_TRENCH_ENDS_ONLY': True,
+        }
+
+    if case == 'concentric_donut_buffers':
+        return {
+            'INPUT_LAYER': data.cached(data_dir, f'coastline_{size}.gpkg', data.coastline, size),
+            'OUTPUT_FOLDER': os.path.join(work_dir, 'donut_buffers'),
+            'CUSTOM_DISTANCES': '2, 5, 10, 20',
+            'ADD_TO_PROJECT': False,
+        }
+
+    if case == 'layout_extent_polygon':
+        from qgis.core import QgsLayoutItemMap, QgsPrintLayout, QgsProject, QgsRectangle, QgsCoordinateReferenceSystem
+        project = QgsProject.instance()
+        project.setCrs(QgsCoordinateReferenceSystem(data.CRS))
+        # homePath() is where the algorithm keeps atlas.shp
+        project.setFileName(os.path.join(work_dir, 'benchmark.qgz'))
+        data.atlas_sheets(os.path.join(work_dir, 'atlas.shp'), size)
+
+        layout = QgsPrintLayout(project)
+        layout.initializeDefaults()
+        layout.setName('Benchmark')
+        map_item = QgsLayoutItemMap(layout)
+        map_item.setId('Map 1')
+        map_item.attemptSetSceneRect(map_item.rect().adjusted(0, 0, 200, 140))
+        layout.addLayoutItem(map_item)
+        map_item.setExtent(QgsRectangle(350000, 650000, 354000, 652800))
+        project.layoutManager().addLayout(layout)
+        return {'LAYOUT_NAME': 'Benchmark', 'MAP_NAME': 0, 'CUSTOM_MAP_NAME': '', 'EXP_1': "'bench'", 'EXP_2': ''}
+
+    if case == 'bulk_regex_field_rewrite':
+        source = data.cached(data_dir, f'points_{size}_old.gpkg', data.points, size, 1, 0)
+        return {
+            'INPUT_LAYER': copy_gpkg(source, work_dir),
+            'RULES': 'PrefRef | PRN |\nMonUID | [2:]\nLockedDate | [:10]',
+            'BATCH_SIZE': 10000,
+        }
+
+    if case == 'atlas_sheet_lookup':
+        atlas = os.path.join(work_dir, 'atlas.shp')
+        data.atlas_sheets(atlas, 2000)
+        return {
+            'INPUT': data.cached(data_dir, f'points_{size}_old.gpkg', data.points, size, 1, 0),
+            'ATLAS': atlas,
+            'SHEETS_FIELD': 'sheets',
+            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT,
+        }
+
+    if case == 'vacuum_geopackage':
+        import sqlite3
+        source = data.cached(data_dir, f'points_{size}_old.gpkg', data.points, size, 1, 0)
+        path = copy_gpkg(source, work_dir)
+        # leave half the file as free pages for VACUUM to reclaim
+        with sqlite3.connect(path) as conn:
+            conn.execute(f'DELETE FROM "points_{size}_old" WHERE uid % 2 = 0')
+        return {'file_path': path}
+
+    raise ValueError(f"Unknown case {case}")
+
+
+def run_single(case, size, data_dir):
+    """Run one case in this process and return its result record."""
+    script, class_name, _, unit = CASES[case]
+    sys.path.insert(0, BENCHMARK_DIR)
+    # the scripts import johan_profiler and atlas_index from here, like QGIS does from its scripts folder
+    sys.path.insert(0, REPO_DIR)
+    app = start_qgis()
+    from qgis.core import Qgis, QgsProcessingContext, QgsProcessingFeedback, QgsProject
+
+    work_dir = tempfile.mkdtemp(prefix=f'bench_{case}_')
+    try:
+        module = load_script(script)
+        parameters = setup_case(case, size, data_dir, work_dir)
+        rss_before = peak_rss_mb()
+
+        if class_name is None:
+            start = time.perf_counter()
+            ok = module.vacuum_geopackage(parameters['file_path'])
+            wall = time.perf_counter() - start
+        else:
+            algorithm = getattr(module, class_name)().create()
+            context = QgsProcessingContext()
+            context.setProject(QgsProject.instance())
+            feedback = QgsProcessingFeedback()
+            start = time.perf_counter()
+            _, ok = algorithm.run(parameters, context, feedback)
+            wall = time.perf_counter() - start
+    finally:
+        QgsProject.instance().clear()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    rss_after = peak_rss_mb()
+    return {
+        'case': case,
+        'size': size,
+        'unit': unit,
+        'ok': bool(ok),
+        'wall_s': round(wall, 4),
+        'peak_rss_mb': round(rss_after, 1) if rss_after is not None else None,
+        'setup_rss_mb': round(rss_before, 1) if rss_before is not None else None,
+        'per_s': round(size / wall, 1) if wall > 0 else None,
+        'qgis': Qgis.version(),
+    }
+
+
+def run_in_subprocess(case, size, data_dir, timeout):
+    command = [sys.executable, os.path.abspath(__file__), '--single', case, '--size', str(size), '--data-dir', data_dir]
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {'case': case, 'size': size, 'ok': False, 'error': f'timed out after {timeout} s'}
+    for line in reversed(completed.stdout.splitlines()):
+        if line.startswith('{'):
+            return json.loads(line)
+    error = (completed.stderr.strip().splitlines() or ['no output'])[-1]
+    return {'case': case, 'size': size, 'ok': False, 'error': error}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def previous_result(history, case, size):
+    for run in reversed(history):
+        for result in run['results']:
+            if result['case'] == case and result['size'] == size and result.get('ok'):
+                return result, run
+    return None, None
+
+
+def report(results, history, threshold):
+    """Print the results next to the last recorded run of each case, returning how many regressed."""
+    regressions = 0
+    print(f"{'case':<28}{'size':>10}{'wall s':>10}{'peak MB':>10}{'per s':>12}  vs last")
+    for result in results:
+        if not result.get('ok'):
+            print(f"{result['case']:<28}{result['size']:>10}  FAILED {result.get('error', '')}")
+            continue
+        previous, run = previous_result(history, result['case'], result['size'])
+        change = ''
+        if previous:
+            ratio = result['wall_s'] / previous['wall_s'] if previous['wall_s'] else 1
+            change = f"{(ratio - 1) * 100:+.0f}% ({run.get('commit') or run['timestamp']})"
+            if ratio > 1 + threshold:
+                change += '  REGRESSION'
+                regressions += 1
+        peak = result['peak_rss_mb'] if result['peak_rss_mb'] is not None else '-'
+        print(f"{result['case']:<28}{result['size']:>10}{result['wall_s']:>10}{peak:>10}{result['per_s']:>12}  {change}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Johan Scripts algorithms on synthetic data.")
+    parser.add_argument('--cases', nargs='*', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--sizes', nargs='*', type=int, default=DEFAULT_SIZES,
+                        help="features (vertices for the buffers, existing sheets for the atlas)")
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR, help="where generated datasets are cached")
+    parser.add_argument('--history', default=DEFAULT_HISTORY)
+    parser.add_argument('--threshold', type=float, default=0.1, help="slow-down that counts as a regression")
+    parser.add_argument('--timeout', type=int, default=3600, help="seconds before a single case is abandoned")
+    parser.add_argument('--no-save', action='store_true', help="don't add this run to the history")
+    parser.add_argument('--profile', help="cprofile and/or trace, passed to the algorithms as JOHAN_PROFILE")
+    parser.add_argument('--list', action='store_true', help="list the cases and exit")
+    parser.add_argument('--single', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.list:
+        for case, (script, _, max_size, unit) in CASES.items():
+            print(f"{case:<28}{script:<36}up to {max_size} {unit}")
+        return 0
+
+    if args.single:
+        print(json.dumps(run_single(args.single, args.size, args.data_dir)))
+        return 0
+
+    if args.profile:
+        # the case subprocesses inherit it, dumps go to JOHAN_PROFILE_DIR or the temp folder
+        os.environ['JOHAN_PROFILE'] = args.profile
+
+    results = []
+    for case in args.cases:
+        for size in args.sizes:
+            if size > CASES[case][2]:
+                print(f"skipping {case} at {size}, more than {CASES[case][2]} {CASES[case][3]} is not worth the wait")
+                continue
+            print(f"running {case} at {size}...", flush=True)
+            results.append(run_in_subprocess(case, size, args.data_dir, args.timeout))
+
+    history = load_history(args.history)
+    regressions = report(results, history, args.threshold)
+
+    if not args.no_save:
+        history.append({
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+        })
+        with open(args.history, 'w', encoding='utf-8') as f:
+            json.dump(history, f, indent=1)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""
+Reproducible synthetic GeoPackages for the benchmarks.
+
+Every dataset is a pure function of its kind, size and seed, so the same file is produced on every machine.
+Files are cached in the data folder and only generated the first time they are asked for.
+"""
+import math
+import os
+import random
+
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransformContext,
+    QgsFeature,
+    QgsField,
+    QgsFields,
+    QgsGeometry,
+    QgsPointXY,
+    QgsRectangle,
+    QgsVectorFileWriter,
+    QgsWkbTypes
+)
+from qgis.PyQt.QtCore import QVariant
+
+CRS = 'EPSG:27700'
+# roughly the extent of British National Grid
+WIDTH = 700000
+HEIGHT = 1300000
+WRITE_BATCH = 50000
+
+
+def _writer(path, fields, wkb_type):
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = 'GPKG'
+    options.layerName = os.path.splitext(os.path.basename(path))[0]
+    writer = QgsVectorFileWriter.create(
+        path, fields, wkb_type, QgsCoordinateReferenceSystem(CRS), QgsCoordinateTransformContext(), options
+    )
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise RuntimeError(f"Could not create {path}: {writer.errorMessage()}")
+    return writer
+
+
+def _write(path, fields, wkb_type, features):
+    """Stream the features into a new GeoPackage, writing to a temp name so half-written files are never cached."""
+    temp_path = path + '.part.gpkg'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    writer = _writer(temp_path, fields, wkb_type)
+    batch = []
+    for feature in features:
+        batch.append(feature)
+        if len(batch) >= WRITE_BATCH:
+            writer.addFeatures(batch)
+            batch = []
+    if batch:
+        writer.addFeatures(batch)
+    del writer  # closes the file
+    os.replace(temp_path, path)
+    return path
+
+
+def _hashed_point(uid, seed):
+    """Same uid and seed always land on the same spot, without keeping a random generator per point."""
+    x = ((uid * 2654435761 + seed * 40503) % 4294967296) / 4294967296 * WIDTH
+    y = ((uid * 2246822519 + seed * 3266489917) % 4294967296) / 4294967296 * HEIGHT
+    return QgsPointXY(x, y)
+
+
+def her_point_fields():
+    fields = QgsFields()
+    fields.append(QgsField('uid', QVariant.LongLong))
+    fields.append(QgsField('PrefRef', QVariant.String))
+    fields.append(QgsField('MonUID', QVariant.String))
+    fields.append(QgsField('LockedDate', QVariant.String))
+    return fields
+
+
+def _points(fields, first_uid, count, seed):
+    for uid in range(first_uid, first_uid + count):
+        feature = QgsFeature(fields)
+        feature.setGeometry(QgsGeometry.fromPointXY(_hashed_point(uid, seed)))
+        feature.setAttributes([uid, f'PRN{uid}', f'MO{uid}', f'20{uid % 25:02d}-0{uid % 9 + 1}-1{uid % 10} 12:00:00.000'])
+        yield feature
+
+
+def points(path, count, seed=1, first_uid=0):
+    """HER style findspots with the text fields the REGEX replace recipes clean up."""
+    fields = her_point_fields()
+    return _write(path, fields, QgsWkbTypes.Point, _points(fields, first_uid, count, seed))
+
+
+def lines(path, count, seed=1):
+    """Short random walks of 2-10 vertices."""
+    fields = QgsFields()
+    fields.append(QgsField('uid', QVariant.LongLong))
+    rng = random.Random(seed)
+
+    def features():
+        for uid in range(count):
+            start = _hashed_point(uid, seed)
+            vertices = [start]
+            for _ in range(rng.randint(1, 9)):
+                last = vertices[-1]
+                vertices.append(QgsPointXY(last.x() + rng.uniform(-50, 50), last.y() + rng.uniform(-50, 50)))
+            feature = QgsFeature(fields)
+            feature.setGeometry(QgsGeometry.fromPolylineXY(vertices))
+            feature.setAttributes([uid])
+            yield feature
+
+    return _write(path, fields, QgsWkbTypes.LineString, features())
+
+
+def trenches(path, count, seed=1):
+    """Evaluation trenches - 30 x 2 m rectangles at random angles."""
+    fields = QgsFields()
+    fields.append(QgsField('uid', QVariant.LongLong))
+    rng = random.Random(seed)
+
+    def features():
+        for uid in range(count):
+            centre = _hashed_point(uid, seed)
+            angle = rng.uniform(0, math.pi)
+            dx, dy = math.cos(angle), math.sin(angle)
+            half_length, half_width = 15, 1
+            corners = [
+                QgsPointXY(centre.x() + sx * half_length * dx - sy * half_width * dy,
+                           centre.y() + sx * half_length * dy + sy * half_width * dx)
+                for sx, sy in ((-1, -1), (1, -1), (1, 1), (-1, 1))
+            ]
+            feature = QgsFeature(fields)
+            feature.setGeometry(QgsGeometry.fromPolygonXY([corners + [corners[0]]]))
+            feature.setAttributes([uid])
+            yield feature
+
+    return _write(path, fields, QgsWkbTypes.Polygon, features())
+
+
+def coastline(path, vertices, seed=1):
+    """One complex island polygon with the given number of vertices, for the buffer benchmarks."""
+    fields = QgsFields()
+    fields.append(QgsField('uid', QVariant.LongLong))
+    rng = random.Random(seed)
+    # a few overlapping sine waves make a wiggly but never self-intersecting outline
+    waves = [(rng.randint(3, 400), rng.uniform(0, 2 * math.pi), rng.uniform(500, 4000)) for _ in range(12)]
+    centre_x, centre_y, radius = WIDTH / 2, HEIGHT / 2, 60000
+
+    ring = []
+    for i in range(vertices):
+        theta = 2 * math.pi * i / vertices
+        r = radius + sum(amplitude * math.sin(frequency * theta + phase) for frequency, phase, amplitude in waves)
+        ring.append(QgsPointXY(centre_x + r * math.cos(theta), centre_y + r * math.sin(theta)))
+    ring.append(ring[0])
+
+    feature = QgsFeature(fields)
+    feature.setGeometry(QgsGeometry.fromPolygonXY([ring]))
+    feature.setAttributes([1])
+    return _write(path, fields, QgsWkbTypes.Polygon, [feature])
+
+
+def atlas_sheets(path, count, seed=1):
+    """An existing atlas.shp with count A4-ish 1:10000 sheets, as left behind by Create Layout Extent Polygon."""
+    fields = QgsFields()
+    fields.append(QgsField('order', QVariant.Int))
+    fields.append(QgsField('scale', QVariant.String))
+    fields.append(QgsField('layout', QVariant.String))
+    fields.append(QgsField('exp_1', QVariant.String))
+    fields.append(QgsField('exp_2', QVariant.String))
+
+    features = []
+    for order in range(1, count + 1):
+        corner = _hashed_point(order, seed)
+        feature = QgsFeature(fields)
+        feature.setGeometry(QgsGeometry.fromRect(QgsRectangle(corner.x(), corner.y(), corner.x() + 4000, corner.y() + 2800)))
+        feature.setAttributes([order, '10000', 'Benchmark', None, None])
+        features.append(feature)
+
+    writer = QgsVectorFileWriter(path, 'UTF-8', fields, QgsWkbTypes.Polygon, QgsCoordinateReferenceSystem(CRS), 'ESRI Shapefile')
+    writer.addFeatures(features)
+    del writer
+    return path
+
+
+def cached(data_folder, name, make, *args):
+    """Path of a dataset in the data folder, generating it first if it is not there yet."""
+    os.makedirs(data_folder, exist_ok=True)
+    path = os.path.join(data_folder, name)
+    if not os.path.exists(path):
+        make(path, *args)
+    return path
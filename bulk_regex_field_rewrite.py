@@ -0,0 +1,192 @@
+import re
+from qgis.core import (QgsProcessing, QgsProcessingAlgorithm, QgsProcessingParameterVectorLayer,
+                       QgsProcessingParameterString, QgsProcessingParameterNumber,
+                       QgsProcessingException, QgsFeatureRequest, QgsVectorDataProvider, NULL)
+from qgis.PyQt.QtCore import QVariant
+
+try:
+    from .johan_profiler import add_profile_parameter, profiled
+except ImportError:
+    # Added through "Add Script" - QGIS puts its scripts folder on sys.path, so johan_profiler.py has to go there too
+    from johan_profiler import add_profile_parameter, profiled
+
+# The recipes from REGEX replace.txt, written as rules
+DEFAULT_RULES = '''# field | pattern | replacement   - regex replace, python syntax (\\1 for groups)
+# field | [start:end]             - keep part of the text, like left() and right()
+PrefRef | PRN |
+MonUID | [2:]
+LockedDate | [:10]'''
+
+SLICE_RULE = re.compile(r'^\[\s*(-?\d*)\s*:\s*(-?\d*)\s*\]$')
+
+
+class BulkRegexFieldRewrite(QgsProcessingAlgorithm):
+    INPUT_LAYER = 'INPUT_LAYER'
+    RULES = 'RULES'
+    BATCH_SIZE = 'BATCH_SIZE'
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                self.INPUT_LAYER,
+                'Layer to clean up (edited in place)',
+                [QgsProcessing.TypeVector]
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.RULES,
+                'Rules, one per line, applied in order',
+                defaultValue=DEFAULT_RULES,
+                multiLine=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.BATCH_SIZE,
+                'Features written per batch',
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=10000,
+                minValue=1
+            )
+        )
+
+        add_profile_parameter(self)
+
+    def parse_rules(self, rules_text, layer):
+        """Turn the rules text into {field index: [rewrite functions]}, compiling each pattern once."""
+        fields = layer.fields()
+        rules = {}
+        for line_number, line in enumerate(rules_text.splitlines(), 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            # The pattern may use | itself, so only the first and last | separate the parts
+            field_name, _, rest = [part.strip() for part in line.partition('|')]
+            field_index = fields.lookupField(field_name)
+            if field_index == -1:
+                raise QgsProcessingException(f'Rule {line_number}: field "{field_name}" not found in {layer.name()}')
+            if fields.at(field_index).type() != QVariant.String:
+                raise QgsProcessingException(f'Rule {line_number}: field "{field_name}" is not a text field')
+
+            slice_match = SLICE_RULE.match(rest)
+            if slice_match:
+                start, end = slice_match.groups()
+                rewrite = self.slice_rewrite(int(start) if start else None, int(end) if end else None)
+            elif '|' in rest:
+                pattern_text, replacement = [part.strip() for part in rest.rsplit('|', 1)]
+                try:
+                    pattern = re.compile(pattern_text)
+                except re.error as e:
+                    raise QgsProcessingException(f'Rule {line_number}: invalid pattern "{pattern_text}" ({e})')
+                rewrite = self.regex_rewrite(pattern, replacement)
+            else:
+                raise QgsProcessingException(
+                    f'Rule {line_number}: expected "field | pattern | replacement" or "field | [start:end]", got "{line}"'
+                )
+
+            rules.setdefault(field_index, []).append(rewrite)
+        return rules
+
+    def regex_rewrite(self, pattern, replacement):
+        return lambda value: pattern.sub(replacement, value)
+
+    def slice_rewrite(self, start, end):
+        return lambda value: value[start:end]
+
+    @profiled
+    def processAlgorithm(self, parameters, context, feedback):
+        layer = self.parameterAsVectorLayer(parameters, self.INPUT_LAYER, context)
+        rules_text = self.parameterAsString(parameters, self.RULES, context)
+        batch_size = self.parameterAsInt(parameters, self.BATCH_SIZE, context)
+
+        if not layer:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT_LAYER))
+
+        provider = layer.dataProvider()
+        if not provider.capabilities() & QgsVectorDataProvider.ChangeAttributeValues:
+            raise QgsProcessingException(f'{layer.name()} can not be edited in place')
+
+        rules = self.parse_rules(rules_text, layer)
+        if not rules:
+            raise QgsProcessingException('No rules given')
+
+        # Only read the fields the rules touch, and no geometry
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(list(rules))
+
+        total = layer.featureCount() or 1
+        changes = {}
+        changed_features = 0
+        changed_values = 0
+
+        current = -1
+
+        # One pass over the layer, every rule applied to each feature as it streams past
+        with self.profiler.phase('rewrite values'):
+            for current, feature in enumerate(layer.getFeatures(request)):
+                if feedback.isCanceled():
+                    break
+
+                attributes = feature.attributes()
+                new_values = {}
+                for field_index, rewrites in rules.items():
+                    value = attributes[field_index]
+                    if value is None or value == NULL:
+                        continue
+                    new_value = value
+                    for rewrite in rewrites:
+                        new_value = rewrite(new_value)
+                    if new_value != value:
+                        new_values[field_index] = new_value
+
+                if new_values:
+                    changes[feature.id()] = new_values
+                    changed_features += 1
+                    changed_values += len(new_values)
+
+                # Write in batches rather than one provider call per feature
+                if len(changes) >= batch_size:
+                    provider.changeAttributeValues(changes)
+                    changes = {}
+
+                if current % 1000 == 0:
+                    feedback.setProgress(int(current * 100 / total))
+
+            if changes:
+                provider.changeAttributeValues(changes)
+
+        self.profiler.count('features read', current + 1)
+        self.profiler.count('values rewritten', changed_values)
+
+        layer.reload()
+        layer.triggerRepaint()
+
+        feedback.pushInfo(f"Values rewritten: {changed_values} in {changed_features} features")
+        if feedback.isCanceled():
+            feedback.pushInfo("Cancelled - features already written keep their new values")
+
+        return {}
+
+    def name(self):
+        return 'bulk_regex_field_rewrite'
+
+    def displayName(self):
+        return 'Bulk Regex Field Rewrite'
+
+    def group(self):
+        return 'Johan Scripts'
+
+    def groupId(self):
+        return 'johan_scripts'
+
+    def createInstance(self):
+        return BulkRegexFieldRewrite()
+
+# Ensure the algorithm is recognized by QGIS when adding it via the "Add Script" tool
+def classFactory(iface):
+    return BulkRegexFieldRewrite()
@@ -1,24 +1,50 @@
+import hashlib
+import json
+import math
 import os
 from qgis.core import (
     QgsProcessing, QgsVectorLayer, QgsProcessingAlgorithm,
     QgsProcessingParameterVectorLayer, QgsProcessingParameterFolderDestination, 
     QgsProcessingParameterString, QgsProcessingParameterBoolean, 
+    QgsProcessingParameterNumber, QgsFeatureRequest,
+    QgsCoordinateReferenceSystem, QgsCoordinateTransform,
+    QgsVectorFileWriter, QgsFeature, QgsFields, QgsWkbTypes,
     QgsProject, QgsSymbol, QgsSimpleLineSymbolLayer, 
     QgsSimpleFillSymbolLayer, QgsFillSymbol, 
     QgsSingleSymbolRenderer, QgsPalLayerSettings, 
     QgsTextFormat, QgsVectorLayerSimpleLabeling, 
-    QgsUnitTypes, QgsProcessingException
+    QgsUnitTypes, QgsProcessingException,
+    QgsGeometry, QgsRectangle, QgsCsException
 )
 from qgis.PyQt.QtGui import QColor, QFont  # Correct import for QColor and QFont
 from qgis.PyQt.QtCore import QCoreApplication  # Correct import for QCoreApplication
 from qgis.core import Qgis
-from qgis import processing  # Correct import for processing module
+
+try:
+    from .johan_profiler import add_profile_parameter, profiled
+except ImportError:
+    # Added through "Add Script" - QGIS puts its scripts folder on sys.path, so johan_profiler.py has to go there too
+    from johan_profiler import add_profile_parameter, profiled
+
+# Finished buffers and rings, so a crashed or cancelled run can pick up where it stopped
+MANIFEST = 'manifest.json'
+
+# Local projections in geodesic mode are centred on the part's centroid, snapped to this many degrees,
+# so neighbouring parts share one projection and one pair of transforms
+LOCAL_CENTRE_STEP = 0.5
+
+# Parts wider or taller than this many degrees are cut into cells this size first, each buffered in its own
+# projection - one projection stretches the distances too much on parts far from its centre
+SPLIT_CELL = 5.0
 
 class ConcentricDonutBuffers(QgsProcessingAlgorithm):
     INPUT_LAYER = 'INPUT_LAYER'
     OUTPUT_FOLDER = 'OUTPUT_FOLDER'
     CUSTOM_DISTANCES = 'CUSTOM_DISTANCES'
     ADD_TO_PROJECT = 'ADD_TO_PROJECT'
+    SEGMENTS = 'SEGMENTS'
+    RESUME = 'RESUME'
+    GEODESIC = 'GEODESIC'
 
     def initAlgorithm(self, config=None):
         # Define input polygon layer as a dropdown of available polygon layers
@@ -46,6 +72,29 @@ class ConcentricDonutBuffers(QgsProcessingAlgorithm):
             defaultValue='2, 5, 10, 20'  # Prepopulated with 2, 5, 10, 20 km
         ))
 
+        # Number of segments for smoother buffers
+        self.addParameter(QgsProcessingParameterNumber(
+            self.SEGMENTS,
+            self.tr('Segments per quarter circle'),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=50,
+            minValue=1
+        ))
+
+        # For lat/lon layers, buffer in metres without reprojecting the whole layer first
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.GEODESIC,
+            self.tr('Geodesic - buffer each part in its own local equidistant projection (for lat/lon layers)'),
+            defaultValue=False
+        ))
+
+        # Reuse buffers and rings already made for the same input and settings
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.RESUME,
+            self.tr('Reuse buffers and rings left in the output folder by earlier runs'),
+            defaultValue=True
+        ))
+
         # Add option to load generated layers into the current project
         self.addParameter(QgsProcessingParameterBoolean(
             self.ADD_TO_PROJECT,
@@ -53,6 +102,9 @@ class ConcentricDonutBuffers(QgsProcessingAlgorithm):
             defaultValue=True
         ))
 
+        add_profile_parameter(self)
+
+    @profiled
     def processAlgorithm(self, parameters, context, feedback):
         # Get the input layer and output folder
         input_layer = self.parameterAsVectorLayer(parameters, self.INPUT_LAYER, context)
@@ -89,57 +141,90 @@ class ConcentricDonutBuffers(QgsProcessingAlgorithm):
 
         # Check if layers should be added to the current project
         add_to_project = self.parameterAsBoolean(parameters, self.ADD_TO_PROJECT, context)
+        segments = self.parameterAsInt(parameters, self.SEGMENTS, context)
+        resume = self.parameterAsBoolean(parameters, self.RESUME, context)
+        geodesic = self.parameterAsBoolean(parameters, self.GEODESIC, context)
+        mode = 'geodesic' if geodesic else 'planar'
+
+        if input_layer.crs().isGeographic() and not geodesic:
+            feedback.pushInfo(f"Warning: {input_layer.crs().authid()} is in degrees - tick Geodesic to buffer in kilometres")
+        self.parts_file = None
+        self.local_transforms = {}
+
+        # Work out what earlier runs already finished for this input
+        manifest_path = os.path.join(output_folder, MANIFEST)
+        with self.profiler.phase('fingerprint input'):
+            fingerprint = self.input_fingerprint(input_layer)
+        manifest = {'input': fingerprint, 'steps': {}}
+        if resume:
+            manifest = self.load_manifest(manifest_path, fingerprint, feedback)
 
         # Step 1: Create all buffers in the order of smallest to largest
         buffers = []
         for i, dist in enumerate(buffer_distances):
+            if feedback.isCanceled():
+                return self.cancelled(feedback)
             buffer_name = buffer_names[i]
+            key = f'buffer|{dist}|{segments}|{mode}'
 
-            # Create buffer for the current distance
-            feedback.pushInfo(f"Creating buffer for {dist / 1000} km...")
-            current_buffer = processing.run("native:buffer", {
-                'INPUT': input_layer,
-                'DISTANCE': dist,
-                'SEGMENTS': 50,  # Number of segments for smoother buffers
-                'DISSOLVE': True,
-                'OUTPUT': 'memory:'
-            }, context=context, feedback=feedback)['OUTPUT']
-
-            buffers.append(current_buffer)
+            done_file = self.finished_step(manifest, key, output_folder)
+            if done_file:
+                feedback.pushInfo(f"Reusing buffer for {dist / 1000} km from {done_file}")
+                buffers.append(done_file)
+                continue
 
-            # Save intermediate buffer for debugging into the gluten_free folder
+            # Create buffer for the current distance, straight into the gluten_free folder
+            feedback.pushInfo(f"Creating buffer for {dist / 1000} km...")
             raw_file = os.path.join(raw_folder, f'{buffer_name}_solid.gpkg')
-            processing.run("native:savefeatures", {
-                'INPUT': current_buffer,
-                'OUTPUT': raw_file
-            }, context=context, feedback=feedback)
+            if geodesic:
+                self.geodesic_buffer(input_layer, dist, segments, raw_folder, raw_file, context, feedback)
+            else:
+                self.profiler.run("native:buffer", {
+                    'INPUT': input_layer,
+                    'DISTANCE': dist,
+                    'SEGMENTS': segments,
+                    'DISSOLVE': True,
+                    'OUTPUT': raw_file
+                }, context=context, feedback=feedback)
+            if feedback.isCanceled():
+                return self.cancelled(feedback)
+
+            self.profiler.file_written(raw_file)
+            self.record_step(manifest_path, manifest, key, raw_file, output_folder)
+            buffers.append(raw_file)
             feedback.pushInfo(f"Saved raw buffer {buffer_name} at {raw_file}")
 
         # Step 2: Sequentially clip buffers using an indexed order
         for i in range(1, len(buffers)):
+            if feedback.isCanceled():
+                return self.cancelled(feedback)
             outer_buffer = buffers[i]
             inner_buffer = buffers[i - 1]
-
-            feedback.pushInfo(f"Clipping buffer {i} ({buffer_names[i]}) with buffer {i - 1} ({buffer_names[i - 1]})...")
-
-            # Clip outer buffer with inner buffer to create a ring
-            ring_buffer = processing.run("native:difference", {
-                'INPUT': outer_buffer,
-                'OVERLAY': inner_buffer,
-                'OUTPUT': 'memory:'
-            }, context=context, feedback=feedback)['OUTPUT']
-
-            # Save the ring buffer
             buffer_name = buffer_names[i]
-            output_file = os.path.join(output_folder, f'{buffer_name}.gpkg')
-
-            processing.run("native:savefeatures", {
-                'INPUT': ring_buffer,
-                'OUTPUT': output_file
-            }, context=context, feedback=feedback)
+            key = f'ring|{buffer_distances[i]}|{buffer_distances[i - 1]}|{segments}|{mode}'
+
+            output_file = self.finished_step(manifest, key, output_folder)
+            if output_file:
+                feedback.pushInfo(f"Reusing donut buffer {buffer_name} from {output_file}")
+            else:
+                feedback.pushInfo(f"Clipping buffer {i} ({buffer_names[i]}) with buffer {i - 1} ({buffer_names[i - 1]})...")
+
+                # Clip outer buffer with inner buffer to create a ring, and save it
+                output_file = os.path.join(output_folder, f'{buffer_name}.gpkg')
+                self.profiler.run("native:difference", {
+                    'INPUT': outer_buffer,
+                    'OVERLAY': inner_buffer,
+                    'OUTPUT': output_file
+                }, context=context, feedback=feedback)
+                if feedback.isCanceled():
+                    return self.cancelled(feedback)
+
+                self.profiler.file_written(output_file)
+                self.record_step(manifest_path, manifest, key, output_file, output_folder)
 
             # Apply the manual styling to the layer
-            self.applyStyles(output_file, context, feedback)
+            with self.profiler.phase('styling'):
+                self.applyStyles(output_file, context, feedback)
 
             # Add layer to the project if the option is enabled
             if add_to_project:
@@ -149,14 +234,23 @@ class ConcentricDonutBuffers(QgsProcessingAlgorithm):
 
         # Save the smallest buffer directly (the first one)
         first_buffer_name = buffer_names[0]
-        first_output_file = os.path.join(output_folder, f'{first_buffer_name}.gpkg')
-        processing.run("native:savefeatures", {
-            'INPUT': buffers[0],
-            'OUTPUT': first_output_file
-        }, context=context, feedback=feedback)
+        key = f'ring|{buffer_distances[0]}|none|{segments}|{mode}'
+        first_output_file = self.finished_step(manifest, key, output_folder)
+        if not first_output_file:
+            first_output_file = os.path.join(output_folder, f'{first_buffer_name}.gpkg')
+            self.profiler.run("native:savefeatures", {
+                'INPUT': buffers[0],
+                'OUTPUT': first_output_file
+            }, context=context, feedback=feedback)
+            if feedback.isCanceled():
+                return self.cancelled(feedback)
+
+            self.profiler.file_written(first_output_file)
+            self.record_step(manifest_path, manifest, key, first_output_file, output_folder)
 
         # Apply the manual styling to the layer
-        self.applyStyles(first_output_file, context, feedback)
+        with self.profiler.phase('styling'):
+            self.applyStyles(first_output_file, context, feedback)
 
         # Add layer to the project if the option is enabled
         if add_to_project:
@@ -165,13 +259,174 @@ class ConcentricDonutBuffers(QgsProcessingAlgorithm):
         feedback.pushInfo(f"Saved smallest buffer {first_buffer_name} at {first_output_file}")
 
         return {}
-            """ 
-            This styling code is not working with V26 and up - WIP
-            to do - 
-                get it working 
-                investigate - is native styling panel possible to bruing into the processing toolbox?
-                give user option to point at QML style file?
-            """
+
+    def geodesic_buffer(self, input_layer, dist, segments, raw_folder, raw_file, context, feedback):
+        """Buffer each dissolved part in an azimuthal equidistant projection centred on it, then dissolve the results.
+
+        Large parts are cut into SPLIT_CELL degree cells and each piece gets its own projection. Parts are read from
+        and written to GeoPackages one at a time, so only one part is ever held in memory.
+        """
+        if self.parts_file is None:
+            # The dissolved input split into parts, made once and shared by every distance
+            dissolved_file = os.path.join(raw_folder, 'dissolved.gpkg')
+            self.parts_file = os.path.join(raw_folder, 'dissolved_parts.gpkg')
+            self.profiler.run("native:dissolve", {
+                'INPUT': input_layer,
+                'OUTPUT': dissolved_file
+            }, context=context, feedback=feedback)
+            self.profiler.run("native:multiparttosingleparts", {
+                'INPUT': dissolved_file,
+                'OUTPUT': self.parts_file
+            }, context=context, feedback=feedback)
+        parts = QgsVectorLayer(self.parts_file, 'dissolved parts', 'ogr')
+
+        layer_crs = parts.crs()
+        wgs84 = QgsCoordinateReferenceSystem('EPSG:4326')
+        to_wgs84 = QgsCoordinateTransform(layer_crs, wgs84, context.transformContext())
+        from_wgs84 = QgsCoordinateTransform(wgs84, layer_crs, context.transformContext())
+
+        parts_buffered = raw_file.replace('.gpkg', '_parts.gpkg')
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = 'GPKG'
+        # No attributes - the dissolve throws them away, and copying the part's fid onto each of its pieces breaks the GPKG
+        writer = QgsVectorFileWriter.create(parts_buffered, QgsFields(), QgsWkbTypes.MultiPolygon, layer_crs,
+                                            context.transformContext(), options)
+        if writer.hasError() != QgsVectorFileWriter.NoError:
+            raise QgsProcessingException(f"Could not create {parts_buffered}: {writer.errorMessage()}")
+
+        with self.profiler.phase('geodesic buffer parts'):
+            for feature in parts.getFeatures():
+                if feedback.isCanceled():
+                    break
+                for geom in self.split_part(feature.geometry(), to_wgs84, from_wgs84):
+                    to_local, from_local = self.local_transform(geom, to_wgs84, layer_crs, context)
+                    geom.transform(to_local)
+                    geom = geom.buffer(dist, segments)
+                    geom.transform(from_local)
+                    geom.convertToMultiType()
+
+                    buffered = QgsFeature()
+                    buffered.setGeometry(geom)
+                    if not writer.addFeature(buffered):
+                        raise QgsProcessingException(f"Could not write to {parts_buffered}: {writer.errorMessage()}")
+                    self.profiler.count('parts buffered')
+        del writer  # closes the file
+
+        if not feedback.isCanceled():
+            self.profiler.run("native:dissolve", {
+                'INPUT': parts_buffered,
+                'OUTPUT': raw_file
+            }, context=context, feedback=feedback)
+        try:
+            os.remove(parts_buffered)
+        except OSError:
+            pass  # still open somewhere (Windows) - it gets written over next time
+
+    def split_part(self, geom, to_wgs84, from_wgs84):
+        """The part cut into SPLIT_CELL degree cells, or just the part if it fits in one.
+
+        Buffering the pieces and dissolving them gives the same shape as buffering the whole part.
+        """
+        try:
+            box = to_wgs84.transformBoundingBox(geom.boundingBox())
+        except QgsCsException:
+            return [geom]
+        if box.width() <= SPLIT_CELL and box.height() <= SPLIT_CELL:
+            return [geom]
+
+        pieces = []
+        lon = math.floor(box.xMinimum() / SPLIT_CELL) * SPLIT_CELL
+        while lon < box.xMaximum():
+            lat = math.floor(box.yMinimum() / SPLIT_CELL) * SPLIT_CELL
+            while lat < box.yMaximum():
+                # Densified so the cell edges follow the lines of longitude and latitude in the layer's CRS
+                cell = QgsGeometry.fromRect(QgsRectangle(lon, max(lat, -90), lon + SPLIT_CELL, min(lat + SPLIT_CELL, 90)))
+                cell = cell.densifyByCount(20)
+                try:
+                    cell.transform(from_wgs84)
+                except QgsCsException:
+                    return [geom]  # the cells don't fit the layer's CRS - buffer the part whole
+                piece = geom.intersection(cell)
+                if not piece.isEmpty():
+                    pieces.append(piece)
+                lat += SPLIT_CELL
+            lon += SPLIT_CELL
+        return pieces
+
+    def local_transform(self, geom, to_wgs84, layer_crs, context):
+        """Transforms to and from the local equidistant projection for a part, made once per projection centre."""
+        try:
+            centre = to_wgs84.transform(geom.centroid().asPoint())
+        except QgsCsException:
+            raise QgsProcessingException(f"Could not place a part in lat/lon from {layer_crs.authid()} to centre its projection")
+        lon = round(centre.x() / LOCAL_CENTRE_STEP) * LOCAL_CENTRE_STEP
+        lat = round(centre.y() / LOCAL_CENTRE_STEP) * LOCAL_CENTRE_STEP
+        if (lon, lat) not in self.local_transforms:
+            local_crs = QgsCoordinateReferenceSystem.fromProj(
+                f'+proj=aeqd +lat_0={lat} +lon_0={lon} +x_0=0 +y_0=0 +datum=WGS84 +units=m +no_defs'
+            )
+            self.local_transforms[(lon, lat)] = (
+                QgsCoordinateTransform(layer_crs, local_crs, context.transformContext()),
+                QgsCoordinateTransform(local_crs, layer_crs, context.transformContext())
+            )
+        return self.local_transforms[(lon, lat)]
+
+    def input_fingerprint(self, layer):
+        """Hash of the input geometries and CRS - a different input never reuses old buffers."""
+        digest = hashlib.blake2b(layer.crs().authid().encode(), digest_size=16)
+        for feature in layer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+            digest.update(bytes(feature.geometry().asWkb()))
+        return digest.hexdigest()
+
+    def load_manifest(self, manifest_path, fingerprint, feedback):
+        """The manifest left by earlier runs, or an empty one if it was for a different input."""
+        manifest = {'input': fingerprint, 'steps': {}}
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, encoding='utf-8') as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                feedback.pushInfo(f"Could not read {manifest_path}, starting from scratch")
+                return manifest
+            if saved.get('input') == fingerprint:
+                manifest['steps'] = saved.get('steps', {})
+                feedback.pushInfo(f"Found {len(manifest['steps'])} finished steps from an earlier run")
+            else:
+                feedback.pushInfo("Input has changed since the last run, starting from scratch")
+        return manifest
+
+    def finished_step(self, manifest, key, output_folder):
+        """Full path of a finished step's file, or None if it needs doing (again)."""
+        relative_path = manifest['steps'].get(key)
+        if relative_path:
+            path = os.path.join(output_folder, relative_path)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def record_step(self, manifest_path, manifest, key, path, output_folder):
+        """Add a finished step and write the manifest, via a temp file so a crash never leaves half a manifest."""
+        relative_path = os.path.relpath(path, output_folder)
+        steps = manifest['steps']
+        # The file may have been written over for different settings
+        for old_key in [k for k, v in steps.items() if v == relative_path]:
+            del steps[old_key]
+        steps[key] = relative_path
+
+        temp_path = manifest_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(temp_path, manifest_path)
+
+    def cancelled(self, feedback):
+        feedback.pushInfo("Cancelled - finished buffers and rings are kept and reused on the next run")
+        return {}
+
+    # This styling code is not working with V26 and up - WIP
+    # to do -
+    #     get it working
+    #     investigate - is native styling panel possible to bruing into the processing toolbox?
+    #     give user option to point at QML style file?
     def applyStyles(self, layer_path, context, feedback):
         """ Manually apply styles to the layer """
         layer = QgsVectorLayer(layer_path, "Styled Layer", "ogr")
@@ -0,0 +1,371 @@
+"""
+Incremental version of the delete-then-insert reload in HANDY SQL FUNCTIONS.txt.
+
+Raw rows are staged once with numbers and dates normalized in bulk and every column converted to the target's type,
+compared with the target by key plus a row hash, and only the inserts, updates and deletes are written,
+in batched transactions. Target rows missing from the raw data are only deleted inside --window
+(or everywhere with --delete-missing).
+Works on sqlite/GeoPackage files out of the box, PostGIS via psycopg2.
+
+python incremental_upsert_loader.py data.gpkg con_project_time_and_expenses project_time_and_expenses
+    --key project_code --key transaction_id --numbers workstage_total_fee workstage_hours_to_date
+    --dates transaction_date --window transaction_date
+
+Dates may be ISO (2024-01-05) or day first (05/01/2024). Anything else stops the load before anything is written.
+"""
+import argparse
+import hashlib
+import sqlite3
+import time
+from contextlib import contextmanager
+
+STAGE_TABLE = '_upsert_stage'
+CURRENT_TABLE = '_upsert_current'
+INSERTS_TABLE = '_upsert_inserts'
+UPDATES_TABLE = '_upsert_updates'
+DELETES_TABLE = '_upsert_deletes'
+BATCH_COLUMN = '_batch_no'
+HASH_COLUMN = '_row_hash'
+
+
+def _row_hash(*values):
+    return hashlib.blake2b(repr(values).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class SqliteBackend:
+    """sqlite and GeoPackage files."""
+
+    placeholder = '?'
+
+    def __init__(self, file_path):
+        self.conn = sqlite3.connect(file_path, isolation_level=None)
+        self.conn.create_function('row_hash', -1, _row_hash, deterministic=True)
+
+    def quote(self, name):
+        return '.'.join('"{}"'.format(part.replace('"', '""')) for part in name.split('.'))
+
+    def columns(self, table):
+        return list(self.column_types(table))
+
+    def column_types(self, table):
+        rows = self.conn.execute(f"PRAGMA table_info({self.quote(table)})").fetchall()
+        return {row[1]: row[2] for row in rows}
+
+    def typed_expr(self, expr, column_type):
+        # the stage table is declared with the target's types, so sqlite converts the values the same way on insert
+        return expr
+
+    def text_expr(self, column):
+        return f"CAST({column} AS TEXT)"
+
+    def number_expr(self, column):
+        # this one gets rid of the commas in numbers like 1,250.50
+        return f"CAST(REPLACE({column}, ',', '') AS REAL)"
+
+    def date_expr(self, column):
+        # ISO dates as they are, dd/mm/yyyy turned round, blanks as NULL - anything else comes out NULL
+        return (
+            f"CASE WHEN {column} IS NULL OR TRIM({column}) = '' THEN NULL "
+            f"WHEN date({column}) IS NOT NULL THEN date({column}) "
+            f"WHEN TRIM({column}) GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9]*' THEN "
+            f"date(substr(TRIM({column}), 7, 4) || '-' || substr(TRIM({column}), 4, 2) || '-' || substr(TRIM({column}), 1, 2)) "
+            f"END"
+        )
+
+    def hash_expr(self, columns):
+        return f"row_hash({', '.join(columns)})"
+
+    def temp_table_sql(self, name, select_sql):
+        return f"CREATE TEMP TABLE {self.quote(name)} AS {select_sql}"
+
+    def create_temp_table(self, name, column_types):
+        columns = ', '.join(f"{self.quote(column)} {column_type}" for column, column_type in column_types.items())
+        self.conn.execute(f"CREATE TEMP TABLE {self.quote(name)} ({columns})")
+
+    def drop_temp_table(self, name):
+        self.conn.execute(f"DROP TABLE IF EXISTS temp.{self.quote(name)}")
+
+    def execute(self, sql, params=()):
+        return self.conn.execute(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        self.conn.execute('BEGIN')
+        try:
+            yield
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def close(self):
+        self.conn.close()
+
+
+class PostgisBackend:
+    """PostgreSQL/PostGIS through psycopg2, e.g. PostgisBackend('dbname=gis user=johan')."""
+
+    placeholder = '%s'
+
+    def __init__(self, dsn):
+        import psycopg2  # only needed when loading into PostGIS
+        self.conn = psycopg2.connect(dsn)
+        self.conn.autocommit = True
+
+    def quote(self, name):
+        return '.'.join('"{}"'.format(part.replace('"', '""')) for part in name.split('.'))
+
+    def columns(self, table):
+        return list(self.column_types(table))
+
+    def column_types(self, table):
+        rows = self.execute(
+            "SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute "
+            "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped ORDER BY attnum",
+            (self.quote(table),)
+        ).fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def typed_expr(self, expr, column_type):
+        return f"CAST({expr} AS {column_type})"
+
+    def text_expr(self, column):
+        return f"{column}::text"
+
+    def number_expr(self, column):
+        return f"CAST(REPLACE({column}::text, ',', '') AS double precision)"
+
+    def date_expr(self, column):
+        # dd/mm/yyyy read day first whatever the server's DateStyle, which defaults to month first.
+        # postgres refuses dates it can't read, so there is no silent NULL to guard against
+        text = f"TRIM({column}::text)"
+        return (
+            f"CASE WHEN {text} ~ '^\\d{{2}}/\\d{{2}}/\\d{{4}}' THEN to_date(substr({text}, 1, 10), 'DD/MM/YYYY') "
+            f"ELSE NULLIF({text}, '')::date END"
+        )
+
+    def hash_expr(self, columns):
+        return f"md5(ROW({', '.join(columns)})::text)"
+
+    def temp_table_sql(self, name, select_sql):
+        return f"CREATE TEMP TABLE {self.quote(name)} AS {select_sql}"
+
+    def create_temp_table(self, name, column_types):
+        columns = ', '.join(f"{self.quote(column)} {column_type}" for column, column_type in column_types.items())
+        self.execute(f"CREATE TEMP TABLE {self.quote(name)} ({columns})")
+
+    def drop_temp_table(self, name):
+        self.execute(f"DROP TABLE IF EXISTS {self.quote(name)}")
+
+    def execute(self, sql, params=()):
+        cursor = self.conn.cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+    @contextmanager
+    def transaction(self):
+        self.conn.autocommit = False
+        try:
+            yield
+        except Exception:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+        finally:
+            self.conn.autocommit = True
+
+    def close(self):
+        self.conn.close()
+
+
+@contextmanager
+def _timed(report, phase):
+    start = time.perf_counter()
+    yield
+    report['timings'][phase] = report['timings'].get(phase, 0.0) + time.perf_counter() - start
+
+
+def _key_match(backend, left, right, key_columns):
+    return ' AND '.join(f"{left}.{backend.quote(k)} = {right}.{backend.quote(k)}" for k in key_columns)
+
+
+def _numbered(backend, select_columns, from_sql):
+    """SELECT with a sequential batch number so the writes can be split into chunks."""
+    return f"SELECT {select_columns}, ROW_NUMBER() OVER () AS {BATCH_COLUMN} {from_sql}"
+
+
+def _check_dates(backend, raw_table, date_columns):
+    """Stop before anything is written if a raw date can't be read, rather than loading it as NULL."""
+    q = backend.quote
+    for column in date_columns:
+        text = backend.text_expr(q(column))
+        bad = backend.execute(
+            f"SELECT {text} FROM {q(raw_table)} "
+            f"WHERE {q(column)} IS NOT NULL AND TRIM({text}) <> '' AND {backend.date_expr(q(column))} IS NULL LIMIT 1"
+        ).fetchone()
+        if bad:
+            raise ValueError(f"Can't read {column} value {bad[0]!r} as a date - use yyyy-mm-dd or dd/mm/yyyy")
+
+
+def incremental_upsert(backend, raw_table, target_table, key_columns, number_columns=(), date_columns=(),
+                       window_column=None, batch_size=5000, delete_missing=False):
+    """
+    Bring target_table in line with raw_table, writing only what changed.
+
+    key_columns identify a row. number_columns and date_columns are normalized on the way in, and every column is
+    converted to the target's type so raw text and typed target values hash the same.
+    Target rows missing from the raw data are only deleted from MIN(window_column) of the raw data onwards - the
+    same window the old DELETE ... WHERE transaction_date >= (SELECT MIN ...) used. Inserts and updates are matched
+    by key against the whole target. Without a window nothing is deleted unless delete_missing is set.
+    Returns a report with the row counts and the time spent in each phase.
+    """
+    report = {'timings': {}, 'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    q = backend.quote
+
+    column_types = backend.column_types(target_table)
+    columns = list(column_types)
+    if not columns:
+        raise ValueError(f"Table {target_table} not found or has no columns")
+    missing = [k for k in key_columns if k not in columns]
+    if missing:
+        raise ValueError(f"Key columns {missing} are not in {target_table}")
+    value_columns = [c for c in columns if c not in key_columns]
+    column_list = ', '.join(q(c) for c in columns)
+
+    for table in (STAGE_TABLE, CURRENT_TABLE, INSERTS_TABLE, UPDATES_TABLE, DELETES_TABLE):
+        backend.drop_temp_table(table)
+
+    # Step 1: stage the raw rows, normalizing numbers and dates once for the whole table
+    with _timed(report, 'stage'):
+        _check_dates(backend, raw_table, date_columns)
+        normalized = []
+        for column in columns:
+            if column in number_columns:
+                expr = backend.number_expr(q(column))
+            elif column in date_columns:
+                expr = backend.date_expr(q(column))
+            else:
+                expr = q(column)
+            normalized.append(backend.typed_expr(expr, column_types[column]))
+
+        # Declared with the target's column types, so staged values are stored exactly as the target stores them
+        backend.create_temp_table(STAGE_TABLE, dict(column_types, **{HASH_COLUMN: 'TEXT'}))
+        backend.execute(
+            f"INSERT INTO {q(STAGE_TABLE)} ({column_list}) SELECT {', '.join(normalized)} FROM {q(raw_table)}"
+        )
+        backend.execute(f"UPDATE {q(STAGE_TABLE)} SET {HASH_COLUMN} = {backend.hash_expr([q(c) for c in columns])}")
+        backend.execute(f"CREATE INDEX {q(STAGE_TABLE + '_key')} ON {q(STAGE_TABLE)} ({', '.join(q(k) for k in key_columns)})")
+
+    # Step 2: key and hash of the target rows that are in play - inside the window, or with a key in the raw data.
+    # The window only limits what can be deleted: a row dated before it whose key comes in again is still updated
+    with _timed(report, 'hash_target'):
+        where = ''
+        if window_column:
+            where = (
+                f" WHERE t.{q(window_column)} >= (SELECT MIN({q(window_column)}) FROM {q(STAGE_TABLE)})"
+                f" OR EXISTS (SELECT 1 FROM {q(STAGE_TABLE)} s WHERE {_key_match(backend, 's', 't', key_columns)})"
+            )
+        backend.execute(backend.temp_table_sql(
+            CURRENT_TABLE,
+            f"SELECT {', '.join(f't.{q(k)}' for k in key_columns)}, "
+            f"{backend.hash_expr([f't.{q(c)}' for c in columns])} AS {HASH_COLUMN} "
+            f"FROM {q(target_table)} t{where}"
+        ))
+        backend.execute(f"CREATE INDEX {q(CURRENT_TABLE + '_key')} ON {q(CURRENT_TABLE)} ({', '.join(q(k) for k in key_columns)})")
+
+    # Step 3: work out the changes
+    with _timed(report, 'diff'):
+        stage_columns = ', '.join(f"s.{q(c)}" for c in columns)
+        backend.execute(backend.temp_table_sql(INSERTS_TABLE, _numbered(
+            backend, stage_columns,
+            f"FROM {q(STAGE_TABLE)} s WHERE NOT EXISTS "
+            f"(SELECT 1 FROM {q(CURRENT_TABLE)} c WHERE {_key_match(backend, 'c', 's', key_columns)})"
+        )))
+        backend.execute(backend.temp_table_sql(UPDATES_TABLE, _numbered(
+            backend, stage_columns,
+            f"FROM {q(STAGE_TABLE)} s JOIN {q(CURRENT_TABLE)} c ON {_key_match(backend, 'c', 's', key_columns)} "
+            f"WHERE s.{HASH_COLUMN} <> c.{HASH_COLUMN}"
+        )))
+        # Without a window a raw extract that only covers part of the target would wipe the rest
+        deletes_filter = '' if window_column or delete_missing else ' AND 1 = 0'
+        backend.execute(backend.temp_table_sql(DELETES_TABLE, _numbered(
+            backend, ', '.join(f"c.{q(k)}" for k in key_columns),
+            f"FROM {q(CURRENT_TABLE)} c WHERE NOT EXISTS "
+            f"(SELECT 1 FROM {q(STAGE_TABLE)} s WHERE {_key_match(backend, 's', 'c', key_columns)}){deletes_filter}"
+        )))
+        counts = {}
+        for table in (INSERTS_TABLE, UPDATES_TABLE, DELETES_TABLE):
+            counts[table] = backend.execute(f"SELECT COUNT(*) FROM {q(table)}").fetchone()[0]
+        staged = backend.execute(f"SELECT COUNT(*) FROM {q(STAGE_TABLE)}").fetchone()[0]
+        report['unchanged'] = staged - counts[INSERTS_TABLE] - counts[UPDATES_TABLE]
+
+    # Step 4: apply them in batched transactions
+    between = f"{BATCH_COLUMN} > {backend.placeholder} AND {BATCH_COLUMN} <= {backend.placeholder}"
+    statements = {
+        DELETES_TABLE: (
+            'deleted',
+            f"DELETE FROM {q(target_table)} WHERE EXISTS (SELECT 1 FROM {q(DELETES_TABLE)} d "
+            f"WHERE {_key_match(backend, 'd', q(target_table), key_columns)} AND d.{between})"
+        ),
+        UPDATES_TABLE: (
+            'updated',
+            f"UPDATE {q(target_table)} SET {', '.join(f'{q(c)} = u.{q(c)}' for c in value_columns)} "
+            f"FROM {q(UPDATES_TABLE)} u WHERE {_key_match(backend, 'u', q(target_table), key_columns)} AND u.{between}"
+        ),
+        INSERTS_TABLE: (
+            'inserted',
+            f"INSERT INTO {q(target_table)} ({column_list}) SELECT {column_list} FROM {q(INSERTS_TABLE)} WHERE {between}"
+        ),
+    }
+    for table, (counter, sql) in statements.items():
+        if counter == 'updated' and not value_columns:
+            continue
+        with _timed(report, counter):
+            for start in range(0, counts[table], batch_size):
+                with backend.transaction():
+                    backend.execute(sql, (start, start + batch_size))
+            report[counter] = counts[table]
+
+    for table in (STAGE_TABLE, CURRENT_TABLE, INSERTS_TABLE, UPDATES_TABLE, DELETES_TABLE):
+        backend.drop_temp_table(table)
+
+    return report
+
+
+def format_report(report):
+    lines = [
+        f"inserted {report['inserted']}, updated {report['updated']}, deleted {report['deleted']}, unchanged {report['unchanged']}"
+    ]
+    for phase, seconds in report['timings'].items():
+        lines.append(f"  {phase:<12} {seconds:8.3f} s")
+    lines.append(f"  {'total':<12} {sum(report['timings'].values()):8.3f} s")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load only the changed rows of a raw table into a target table.")
+    parser.add_argument('database', help="sqlite/GeoPackage file, or a PostGIS connection string with --postgis")
+    parser.add_argument('raw_table')
+    parser.add_argument('target_table')
+    parser.add_argument('--key', action='append', required=True, help="key column, repeat for composite keys")
+    parser.add_argument('--numbers', nargs='*', default=[], help="columns with comma-formatted numbers")
+    parser.add_argument('--dates', nargs='*', default=[], help="columns to cast to dates")
+    parser.add_argument('--window', help="only compare target rows from the earliest raw value of this column onwards")
+    parser.add_argument('--delete-missing', action='store_true',
+                        help="without --window, delete every target row that is not in the raw table")
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--postgis', action='store_true', help="treat database as a psycopg2 connection string")
+    args = parser.parse_args()
+
+    backend = PostgisBackend(args.database) if args.postgis else SqliteBackend(args.database)
+    try:
+        report = incremental_upsert(backend, args.raw_table, args.target_table, args.key, args.numbers, args.dates,
+                                    args.window, args.batch_size, args.delete_missing)
+    finally:
+        backend.close()
+    print(format_report(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Lightweight timing and counters shared by the Johan Scripts algorithms.
+
+Decorate processAlgorithm with @profiled and call add_profile_parameter(self) at the end of initAlgorithm.
+Inside the algorithm, self.profiler gives:
+    with self.profiler.phase('read features'): ...   time a block
+    self.profiler.count('features written', n)      count things
+    self.profiler.file_written(path)                add a file's size to the bytes written
+    self.profiler.run('native:buffer', {...}, ...)  processing.run, timed as a sub-algorithm
+
+A summary goes to the log at the end of every run. For more detail set the JOHAN_PROFILE environment variable
+(or the hidden PROFILE parameter, e.g. from processing.run) to 'cprofile', 'trace' or 'cprofile,trace':
+    cprofile - a .pstats dump, open it with python -m pstats or snakeviz
+    trace    - Chrome trace JSON of the phases, open it in chrome://tracing or https://ui.perfetto.dev
+Files go to JOHAN_PROFILE_DIR, or the temp folder.
+"""
+import cProfile
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from qgis.core import QgsProcessingParameterDefinition, QgsProcessingParameterString
+
+PROFILE = 'PROFILE'
+ENV_VAR = 'JOHAN_PROFILE'
+ENV_DIR = 'JOHAN_PROFILE_DIR'
+BYTES_WRITTEN = 'bytes written'
+
+
+def add_profile_parameter(algorithm):
+    """Hidden parameter so profiling can be switched on per run without touching the environment."""
+    parameter = QgsProcessingParameterString(
+        PROFILE,
+        'Profiling output (cprofile, trace)',
+        defaultValue='',
+        optional=True
+    )
+    parameter.setFlags(parameter.flags() | QgsProcessingParameterDefinition.FlagHidden)
+    algorithm.addParameter(parameter)
+
+
+class RunProfiler:
+    """Phase timings and counters for one algorithm run."""
+
+    def __init__(self, name, feedback, modes=()):
+        self.name = name
+        self.feedback = feedback
+        self.modes = set(modes)
+        self.timings = {}
+        self.calls = {}
+        self.counters = {}
+        self.events = []
+        self.started = time.perf_counter()
+        self.cprofile = None
+        if 'cprofile' in self.modes:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.timings[name] = self.timings.get(name, 0.0) + end - start
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if 'trace' in self.modes:
+                self.events.append((name, start, end, threading.get_ident()))
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def file_written(self, path):
+        """Add the size of a written file (or every file in a written folder) to the bytes written."""
+        if os.path.isdir(path):
+            for folder, _, files in os.walk(path):
+                for file_name in files:
+                    self.count(BYTES_WRITTEN, os.path.getsize(os.path.join(folder, file_name)))
+        elif os.path.exists(path):
+            self.count(BYTES_WRITTEN, os.path.getsize(path))
+
+    def run(self, algorithm_id, parameters, context=None, feedback=None):
+        """processing.run, timed under its algorithm id."""
+        from qgis import processing
+        with self.phase(f'sub-algorithm {algorithm_id}'):
+            return processing.run(algorithm_id, parameters, context=context, feedback=feedback)
+
+    def summary(self):
+        total = time.perf_counter() - self.started
+        lines = [f"Timing summary for {self.name}: {total:.3f} s"]
+        for name, seconds in sorted(self.timings.items(), key=lambda item: -item[1]):
+            share = seconds / total * 100 if total else 0
+            lines.append(f"  {name}: {seconds:.3f} s ({share:.0f}%, {self.calls[name]} calls)")
+        for name, amount in self.counters.items():
+            if name == BYTES_WRITTEN:
+                lines.append(f"  {name}: {amount / 1048576:.1f} MB")
+            else:
+                rate = f", {amount / total:.0f}/s" if total else ''
+                lines.append(f"  {name}: {amount}{rate}")
+        return lines
+
+    def finish(self):
+        if self.cprofile:
+            self.cprofile.disable()
+        for line in self.summary():
+            self.feedback.pushInfo(line)
+        if self.cprofile:
+            path = self._output_path('pstats')
+            self.cprofile.dump_stats(path)
+            self.feedback.pushInfo(f"cProfile stats written to {path}")
+        if 'trace' in self.modes:
+            path = self._output_path('trace.json')
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(self._trace_events(), f)
+            self.feedback.pushInfo(f"Chrome trace written to {path}")
+
+    def _trace_events(self):
+        pid = os.getpid()
+        return {'traceEvents': [
+            {'name': name, 'ph': 'X', 'pid': pid, 'tid': thread,
+             'ts': (start - self.started) * 1e6, 'dur': (end - start) * 1e6}
+            for name, start, end, thread in self.events
+        ]}
+
+    def _output_path(self, extension):
+        folder = os.environ.get(ENV_DIR) or tempfile.gettempdir()
+        os.makedirs(folder, exist_ok=True)
+        stamp = time.strftime('%Y%m%d_%H%M%S')
+        return os.path.join(folder, f'{self.name}_{stamp}.{extension}')
+
+
+def profile_modes(algorithm, parameters, context):
+    """Modes asked for by the hidden parameter, falling back to the environment variable."""
+    value = ''
+    if algorithm.parameterDefinition(PROFILE) is not None:
+        value = algorithm.parameterAsString(parameters, PROFILE, context)
+    value = value or os.environ.get(ENV_VAR, '')
+    return [mode.strip().lower() for mode in value.split(',') if mode.strip()]
+
+
+def profiled(process_algorithm):
+    """Give processAlgorithm a self.profiler and report it however the run ends."""
+    @functools.wraps(process_algorithm)
+    def wrapper(self, parameters, context, feedback):
+        self.profiler = RunProfiler(self.name(), feedback, profile_modes(self, parameters, context))
+        try:
+            return process_algorithm(self, parameters, context, feedback)
+        finally:
+            self.profiler.finish()
+    return wrapper
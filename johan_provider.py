@@ -0,0 +1,138 @@
+"""
+One processing provider for all the Johan Scripts, for when this folder is installed as a QGIS plugin.
+
+The toolbox only gets lightweight stand-ins at startup. Their scripts are imported, and the stand-ins given the
+scripts' parameters, once QGIS has finished starting up, so startup doesn't pay for any of them. Under qgis_process,
+which has no startup to speed up and reads the parameters straight away, they are set up as they are registered.
+"""
+import importlib
+
+from qgis.core import QgsApplication, QgsProcessingAlgorithm, QgsProcessingProvider
+from qgis.PyQt.QtCore import QTimer
+
+# (module, algorithm class, name, display name) - name and display name must match the script's own
+ALGORITHMS = [
+    ('Compare_Layers_by_Attribute', 'CompareLayersAlgorithm', 'compare_layers', 'Compare Layers by Attribute'),
+    ('add_coordinates_to_layer', 'AddCoordinatesToLayer', 'addcoordinatestolayer', 'Add Coordinates to Layer'),
+    ('concentric_donut_buffers', 'ConcentricDonutBuffers', 'concentric_donut_buffers', 'Create Concentric Donut Buffers'),
+    ('layout_extent_polygon', 'CreateLayoutExtentPolygon', 'createlayoutextentpolygon', 'Create Layout Extent Polygon'),
+    ('bulk_regex_field_rewrite', 'BulkRegexFieldRewrite', 'bulk_regex_field_rewrite', 'Bulk Regex Field Rewrite'),
+    ('atlas_sheet_lookup', 'AtlasSheetLookup', 'atlas_sheet_lookup', 'Tag Features with Atlas Sheets'),
+]
+
+
+class LazyAlgorithm(QgsProcessingAlgorithm):
+    """Stands in for a script's algorithm until it is actually needed."""
+
+    def __init__(self, spec, lazy=False):
+        super().__init__()
+        self.spec = spec
+        # The provider's own copy only has to show up in the toolbox at first - populate() fills it in later
+        self.lazy = lazy
+        self.algorithm = None
+
+    def load(self):
+        if self.algorithm is None:
+            module_name, class_name = self.spec[:2]
+            module = importlib.import_module(f'.{module_name}', __package__)
+            self.algorithm = getattr(module, class_name)().create()
+        return self.algorithm
+
+    def initAlgorithm(self, config=None):
+        if self.lazy:
+            return
+        for parameter in self.load().parameterDefinitions():
+            self.addParameter(parameter.clone())
+
+    def populate(self):
+        """Load the script and take on its parameters, for anything reading the registered copy directly
+        (processing.algorithmHelp, qgis_process help, the modeler)."""
+        if self.lazy:
+            self.lazy = False
+            self.initAlgorithm()
+
+    # A run goes through the script's own prepare / process / post-process steps, not just processAlgorithm
+    def prepareAlgorithm(self, parameters, context, feedback):
+        return self.load().prepareAlgorithm(parameters, context, feedback)
+
+    def processAlgorithm(self, parameters, context, feedback):
+        return self.load().processAlgorithm(parameters, context, feedback)
+
+    def postProcessAlgorithm(self, context, feedback):
+        return self.load().postProcessAlgorithm(context, feedback)
+
+    # The toolbox copy keeps the defaults until it is populated
+    def flags(self):
+        return super().flags() if self.lazy else self.load().flags()
+
+    def shortHelpString(self):
+        return '' if self.lazy else self.load().shortHelpString()
+
+    def helpUrl(self):
+        return '' if self.lazy else self.load().helpUrl()
+
+    def icon(self):
+        return super().icon() if self.lazy else self.load().icon()
+
+    def name(self):
+        return self.spec[2]
+
+    def displayName(self):
+        return self.spec[3]
+
+    def group(self):
+        return 'Johan Scripts'
+
+    def groupId(self):
+        return 'johan_scripts'
+
+    def createInstance(self):
+        return LazyAlgorithm(self.spec)
+
+
+class JohanScriptsProvider(QgsProcessingProvider):
+
+    def __init__(self, lazy=True):
+        super().__init__()
+        self.lazy = lazy
+
+    def loadAlgorithms(self):
+        for spec in ALGORITHMS:
+            self.addAlgorithm(LazyAlgorithm(spec, lazy=self.lazy))
+        if self.lazy:
+            # Runs once the event loop is going, i.e. after startup or the toolbox refresh that got us here
+            QTimer.singleShot(0, self.populateAlgorithms)
+
+    def populateAlgorithms(self):
+        for algorithm in self.algorithms():
+            if isinstance(algorithm, LazyAlgorithm):
+                algorithm.populate()
+
+    def id(self):
+        return 'johan_scripts'
+
+    def name(self):
+        return 'Johan Scripts'
+
+    def longName(self):
+        return self.name()
+
+
+class JohanScriptsPlugin:
+    """Registers the provider when the folder is loaded as a plugin."""
+
+    def __init__(self, iface):
+        self.iface = iface
+        self.provider = None
+
+    def initProcessing(self):
+        # qgis_process loads the plugin without an iface, and only ever looks at the registered algorithms
+        self.provider = JohanScriptsProvider(lazy=self.iface is not None)
+        QgsApplication.processingRegistry().addProvider(self.provider)
+
+    def initGui(self):
+        self.initProcessing()
+
+    def unload(self):
+        if self.provider:
+            QgsApplication.processingRegistry().removeProvider(self.provider)
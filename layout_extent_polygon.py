@@ -21,14 +21,26 @@ from qgis.core import (
     QgsSingleSymbolRenderer,
     QgsUnitTypes,
     QgsProcessingParameterExpression,
+    QgsProcessingParameterLayout,
     QgsExpression, 
     QgsExpressionContext, 
-    QgsExpressionContextUtils
+    QgsExpressionContextUtils,
+    Qgis
 )
-import qgis.analysis
 from qgis.PyQt.QtCore import QVariant
 from qgis.PyQt.QtGui import QColor, QFont
 
+try:
+    from . import atlas_index
+    from .johan_profiler import add_profile_parameter, profiled
+except ImportError:
+    # Added through "Add Script" - QGIS puts its scripts folder on sys.path, so johan_profiler.py has to go there too
+    from johan_profiler import add_profile_parameter, profiled
+    try:
+        import atlas_index
+    except ImportError:
+        atlas_index = None  # the sheets are still made, Tag Features with Atlas Sheets rebuilds the index when it needs it
+
 class CreateLayoutExtentPolygon(QgsProcessingAlgorithm):
 
     LAYOUT_NAME = 'LAYOUT_NAME'
@@ -38,14 +50,11 @@ class CreateLayoutExtentPolygon(QgsProcessingAlgorithm):
     EXP_2 = 'EXP_2'
 
     def initAlgorithm(self, config=None):
-        layout_manager = QgsProject.instance().layoutManager()
-        layout_names = [layout.name() for layout in layout_manager.layouts()]
-        
+        # The layout drop-down fills itself from the project when the dialog opens, not when the toolbox loads
         self.addParameter(
-            QgsProcessingParameterEnum(
+            QgsProcessingParameterLayout(
                 self.LAYOUT_NAME,
-                'Layout Name',
-                options=layout_names
+                'Layout Name'
             )
         )
         
@@ -85,28 +94,28 @@ class CreateLayoutExtentPolygon(QgsProcessingAlgorithm):
                 optional=True
             )
         )
-        
-
 
+        add_profile_parameter(self)
 
+    @profiled
     def processAlgorithm(self, parameters, context, feedback):
 
         # Minimal feedback output
         feedback.setProgressText('Processing layout extent polygon...')
         
         try:
-            layout_index = self.parameterAsEnum(parameters, self.LAYOUT_NAME, context)
+            layout = self.parameterAsLayout(parameters, self.LAYOUT_NAME, context)
             map_item_index = self.parameterAsEnum(parameters, self.MAP_NAME, context)
             custom_map_item_name = self.parameterAsString(parameters, self.CUSTOM_MAP_NAME, context)
             exp_1 = self.parameterAsString(parameters, self.EXP_1, context)
             exp_2 = self.parameterAsString(parameters, self.EXP_2, context)
             
-            layout_manager = QgsProject.instance().layoutManager()
-            layout_name = layout_manager.layouts()[layout_index].name()
-            layout = layout_manager.layoutByName(layout_name)
+            if not layout:
+                raise QgsProcessingException('Layout not found in the project')
+            layout_name = layout.name()
 
             # Map Name drop-down options for user convinience the processing toolbox API does not have the option to auto-populate this
-            map_item_names = ['Map 1', 'ADD YOUR STANDARD MAP WINDOW ITEM ID'S TO THE SCRIPT']
+            map_item_names = ['Map 1', "ADD YOUR STANDARD MAP WINDOW ITEM ID'S TO THE SCRIPT"]
             map_item_name = custom_map_item_name if custom_map_item_name else map_item_names[map_item_index]
             
             map_item = layout.itemById(map_item_name)
@@ -135,12 +144,17 @@ class CreateLayoutExtentPolygon(QgsProcessingAlgorithm):
                 ])
                 polygon_layer.updateFields()
                 order = 1
+                sheet_index = None
             else:
-                polygon_layer = QgsVectorLayer(output_path, 'atlas', 'ogr')
-                if not polygon_layer.isValid():
-                    raise QgsProcessingException(f'Failed to load existing layer: {output_path}')
-                features = list(polygon_layer.getFeatures())
-                order = max([f['order'] for f in features], default=0) + 1
+                # Sheet index as it was before this sheet, so the new one can just be added to it
+                sheet_index = atlas_index.read_index(output_path) if atlas_index else None
+                with self.profiler.phase('read atlas'):
+                    polygon_layer = QgsVectorLayer(output_path, 'atlas', 'ogr')
+                    if not polygon_layer.isValid():
+                        raise QgsProcessingException(f'Failed to load existing layer: {output_path}')
+                    features = list(polygon_layer.getFeatures())
+                    order = max([f['order'] for f in features], default=0) + 1
+                self.profiler.count('features read', len(features))
             
             points = [
                 QgsPointXY(extent.xMinimum(), extent.yMinimum()),
@@ -166,7 +180,15 @@ class CreateLayoutExtentPolygon(QgsProcessingAlgorithm):
             polygon_layer.dataProvider().addFeature(feature)
             
             # Save the layer to the specified output path
-            QgsVectorFileWriter.writeAsVectorFormat(polygon_layer, output_path, "UTF-8", polygon_layer.crs(), "ESRI Shapefile", False)
+            with self.profiler.phase('write atlas'):
+                QgsVectorFileWriter.writeAsVectorFormat(polygon_layer, output_path, "UTF-8", polygon_layer.crs(), "ESRI Shapefile", False)
+            self.profiler.count('features written', polygon_layer.featureCount())
+            self.profiler.file_written(output_path)
+            
+            # Keep the sheet index used by Tag Features with Atlas Sheets up to date
+            if atlas_index:
+                with self.profiler.phase('update sheet index'):
+                    atlas_index.append_sheet(output_path, sheet_index, order, scale, extent)
             
             # Add or update the saved layer in the project
             existing_layers = QgsProject.instance().mapLayersByName('atlas')
@@ -183,7 +205,8 @@ class CreateLayoutExtentPolygon(QgsProcessingAlgorithm):
                     raise QgsProcessingException(f'Error adding layer to project: {output_path}')
             
             # Apply symbol and labeling styles
-            self.applyStyles(polygon_layer)
+            with self.profiler.phase('styling'):
+                self.applyStyles(polygon_layer)
             
         
             # Limit feedback messages
@@ -1,6 +1,4 @@
 import sqlite3
-import tkinter as tk
-from tkinter import filedialog, messagebox
 
 def vacuum_geopackage(file_path):
     try:
@@ -12,6 +10,10 @@ def vacuum_geopackage(file_path):
         return False
 
 def select_and_vacuum_file():
+    # tkinter is only needed for the file picker, so vacuum_geopackage can be imported headless
+    import tkinter as tk
+    from tkinter import filedialog, messagebox
+
     root = tk.Tk()
     root.withdraw()  # Hide the main tkinter window
 
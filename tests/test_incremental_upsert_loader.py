@@ -0,0 +1,88 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from incremental_upsert_loader import SqliteBackend, incremental_upsert
+
+
+class IncrementalUpsertSqliteTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        with sqlite3.connect(self.path) as conn:
+            # raw extract is all text, the target is typed
+            conn.execute('CREATE TABLE raw (id TEXT, hours TEXT, fee TEXT, day TEXT)')
+            conn.execute('CREATE TABLE target (id INTEGER, hours INTEGER, fee REAL, day DATE)')
+            conn.executemany('INSERT INTO raw VALUES (?, ?, ?, ?)', [
+                ('1', '3', '1,250.50', '2024-01-05'),
+                ('2', '7', '80', '05/02/2024'),
+            ])
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def load(self, **kwargs):
+        backend = SqliteBackend(self.path)
+        try:
+            return incremental_upsert(backend, 'raw', 'target', ['id'], ['fee'], ['day'], **kwargs)
+        finally:
+            backend.close()
+
+    def test_second_load_of_same_data_changes_nothing(self):
+        first = self.load()
+        self.assertEqual(first['inserted'], 2)
+
+        second = self.load()
+        self.assertEqual((second['inserted'], second['updated'], second['deleted']), (0, 0, 0))
+        self.assertEqual(second['unchanged'], 2)
+
+        with sqlite3.connect(self.path) as conn:
+            rows = conn.execute('SELECT id, hours, fee, day FROM target ORDER BY id').fetchall()
+        self.assertEqual(rows, [(1, 3, 1250.5, '2024-01-05'), (2, 7, 80.0, '2024-02-05')])
+
+    def test_changed_row_is_updated(self):
+        self.load()
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("UPDATE raw SET hours = '8' WHERE id = '2'")
+        report = self.load()
+        self.assertEqual((report['updated'], report['unchanged']), (1, 1))
+
+    def test_missing_rows_only_deleted_when_asked(self):
+        self.load()
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("DELETE FROM raw WHERE id = '1'")
+        self.assertEqual(self.load()['deleted'], 0)
+        self.assertEqual(self.load(delete_missing=True)['deleted'], 1)
+
+    def test_window_only_limits_deletes(self):
+        self.load()
+        with sqlite3.connect(self.path) as conn:
+            # row 1's date is corrected from before the window to inside it
+            conn.execute("UPDATE target SET day = '2023-12-01' WHERE id = 1")
+            conn.execute("UPDATE raw SET day = '2024-03-01' WHERE id = '1'")
+            # missing from the raw data: row 4 before the window, row 5 inside it
+            conn.execute("INSERT INTO target VALUES (4, 1, 10, '2023-06-01')")
+            conn.execute("INSERT INTO target VALUES (5, 1, 10, '2024-04-01')")
+        report = self.load(window_column='day')
+        self.assertEqual((report['inserted'], report['updated'], report['deleted']), (0, 1, 1))
+
+        with sqlite3.connect(self.path) as conn:
+            rows = conn.execute('SELECT id, day FROM target ORDER BY id').fetchall()
+        self.assertEqual(rows, [(1, '2024-03-01'), (2, '2024-02-05'), (4, '2023-06-01')])
+
+    def test_unreadable_date_stops_the_load(self):
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("UPDATE raw SET day = '5th Jan' WHERE id = '1'")
+        with self.assertRaises(ValueError):
+            self.load()
+        with sqlite3.connect(self.path) as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM target').fetchone()[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()